@@ -0,0 +1,159 @@
+"""
+Micro benchmarks for utensils.dictutils. Run with:
+
+    python -m benchmarks.dictutils_bench
+"""
+import operator
+import random
+import re
+import timeit
+import tracemalloc
+
+from utensils.dictutils import apply_to_dict
+from utensils.dictutils import APPLY_MODES
+from utensils.dictutils import compile_path
+from utensils.dictutils import get_dotted
+from utensils.dictutils import order
+
+ARRAY_ACCESSOR = re.compile(r'(.*)\[(.*?)\]')
+
+DOC = {
+    'a': {'b': {'c': {'d': {'e': {'f': 1}}}}},
+    'items': [{'id': i, 'name': 'item%s' % i, 'meta': {'score': i}}
+        for i in range(10)],
+}
+
+PATHS = [
+    'a.b.c.d.e.f',
+    'items[3].meta.score',
+    'items[@id=7].name',
+    'items[*].meta.score',
+]
+
+def legacy_get_dotted(data, field, default=None, delimiter='.'):
+    """
+    get_dotted as it was before paths were compiled, kept for comparison.
+    """
+    components = field.split(delimiter)
+    components.reverse()
+    while components and isinstance(data, dict):
+        component = components.pop()
+        accessor = None
+        match = re.match(ARRAY_ACCESSOR, component)
+        if match:
+            component = match.group(1)
+            accessor = match.group(2)
+        data = data.get(component)
+        if accessor:
+            if "@" in accessor:
+                params = {}
+                for pairs in accessor.split('@')[1:]:
+                    params[pairs.split('=')[0]] = pairs.split('=')[1]
+                data = data if isinstance(data, list) else [data]
+                for item in data:
+                    for key, value in params.items():
+                        if str(item[key]) != str(value):
+                            break
+                    else:
+                        data = item
+                        break
+            elif "*" in accessor:
+                cur_fields = delimiter.join(components[::-1])
+                return [legacy_get_dotted(d, cur_fields) for d in data]
+            else:
+                data = operator.getitem(data, int(accessor))
+    if components or data == None:
+        return default
+    return data
+
+def legacy_apply_to_dict(data, _function):
+    """
+    Recursive apply_to_dict as it was before, kept for comparison.
+    """
+    if type(data) == dict:
+        data = dict(data)
+        for key in data:
+            data[key] = legacy_apply_to_dict(data[key], _function)
+    elif type(data) == list:
+        data = list(data)
+        for i, item in enumerate(data):
+            data[i] = legacy_apply_to_dict(item, _function)
+    else:
+        data = _function(data)
+    return data
+
+def _wide_doc(width=200000):
+    return {'k%s' % i: {'v': 'value%s' % i, 'n': [i, i + 1]}
+        for i in range(width)}
+
+def _deep_doc(depth=200, width=500):
+    doc = cur = {}
+    for i in range(depth):
+        cur['leaves'] = ['value%s' % j for j in range(width)]
+        cur['child'] = cur = {}
+    return doc
+
+def _scrub(value):
+    # Only touches a tiny fraction of the leaves.
+    return 'xxx' if value == 'value7' else value
+
+def _measure(fn, make_doc):
+    doc = make_doc()
+    start = timeit.default_timer()
+    fn(doc)
+    elapsed = timeit.default_timer() - start
+    doc = make_doc()
+    tracemalloc.start()
+    fn(doc)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+def bench_apply_to_dict():
+    print('%-12s %-10s %10s %12s' % ('doc', 'mode', 'time', 'peak mem'))
+    for name, make_doc in (('wide', _wide_doc), ('deep', _deep_doc)):
+        runs = [('legacy', lambda d: legacy_apply_to_dict(d, _scrub))]
+        for mode in APPLY_MODES:
+            runs.append((mode,
+                lambda d, mode=mode: apply_to_dict(d, _scrub, mode=mode)))
+        for label, fn in runs:
+            elapsed, peak = _measure(fn, make_doc)
+            print('%-12s %-10s %8.3fs %10.1fMB' % (name, label, elapsed,
+                peak / 1024.0 / 1024))
+
+def bench_order(size=1000000, limit=20):
+    rng = random.Random(0)
+    dict_ = dict(('k%s' % i, rng.random()) for i in range(size))
+    print('order %s items by value, keep %s' % (size, limit))
+    full = lambda: list(order(dict_, by_value=True, reverse=True).items())[:limit]
+    top = lambda: order(dict_, by_value=True, reverse=True, limit=limit,
+            dict_type=dict)
+    assert full() == list(top().items())
+    for label, fn in (('full sort', full), ('limit', top)):
+        print('%-12s %8.3fs' % (label, min(timeit.repeat(fn, number=1,
+            repeat=3))))
+
+def _per_call(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def bench_get_dotted(number=20000):
+    print('%-22s %10s %10s %10s' % ('path', 'legacy', 'get_dotted', 'compiled'))
+    for field in PATHS:
+        path = compile_path(field)
+        assert legacy_get_dotted(DOC, field) == path.get(DOC)
+        print('%-22s %8.2fus %8.2fus %8.2fus' % (
+            field,
+            _per_call(lambda: legacy_get_dotted(DOC, field), number),
+            _per_call(lambda: get_dotted(DOC, field), number),
+            _per_call(lambda: path.get(DOC), number),
+            ))
+
+def main():
+    bench_get_dotted()
+    print('')
+    bench_apply_to_dict()
+    print('')
+    bench_order()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Micro benchmarks for utensils.listutils. Run with:
+
+    python -m benchmarks.listutils_bench
+"""
+import collections.abc
+import timeit
+import tracemalloc
+
+from utensils.listutils import OrderedSet
+
+class LegacyOrderedSet(collections.abc.MutableSet):
+    """
+    The linked list recipe OrderedSet used to be, kept for comparison.
+    """
+
+    def __init__(self, iterable=None):
+        self.end = end = []
+        end += [None, end, end]
+        self.map = {}
+        if iterable is not None:
+            self |= iterable
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def add(self, key):
+        if key not in self.map:
+            end = self.end
+            curr = end[1]
+            curr[2] = end[1] = self.map[key] = [key, curr, end]
+
+    def discard(self, key):
+        if key in self.map:
+            key, prev, next = self.map.pop(key)
+            prev[2] = next
+            next[1] = prev
+
+    def __iter__(self):
+        end = self.end
+        curr = end[2]
+        while curr is not end:
+            yield curr[0]
+            curr = curr[2]
+
+def _bytes_per_element(make, keys):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    ordered_set = make(keys)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert len(ordered_set) == len(keys)
+    return float(used) / len(keys)
+
+def _ops_per_sec(fn, count, number=3):
+    return count / (min(timeit.repeat(fn, number=1, repeat=number)))
+
+def bench_ordered_set(size=1000000):
+    # Keys are created up front, so only the set itself is measured.
+    keys = list(range(size))
+    other = list(range(size // 2, size + size // 2))
+    impls = (
+        ('legacy', LegacyOrderedSet),
+        ('dict', OrderedSet),
+        ('indexed', lambda keys: OrderedSet(keys, indexed=True)),
+        )
+    print('OrderedSet with %s keys' % size)
+    print('%-10s %10s %12s %12s %12s %12s' % ('impl', 'bytes/key',
+        'build/s', 'contains/s', 'iter/s', 'and/s'))
+    for label, make in impls:
+        ordered_set = make(keys)
+        print('%-10s %10.1f %12.0f %12.0f %12.0f %12.0f' % (
+            label,
+            _bytes_per_element(make, keys),
+            _ops_per_sec(lambda: make(keys), size),
+            _ops_per_sec(lambda: [k in ordered_set for k in other], size),
+            _ops_per_sec(lambda: list(ordered_set), size),
+            _ops_per_sec(lambda: ordered_set & other, size),
+            ))
+
+def bench_indexed_discards(size=200000, discards=4000):
+    # Interleaved discards and positional reads, which used to compact the
+    # whole set on every read after a discard.
+    def run():
+        ordered_set = OrderedSet(range(size), indexed=True)
+        for i in range(0, 2 * discards, 2):
+            ordered_set.discard(i)
+            assert ordered_set[i // 2] == i + 1
+            ordered_set.index(i + 2)
+    print('OrderedSet with %s keys, %s discards each followed by reads' % (
+        size, discards))
+    print('%-10s %12s' % ('impl', 'discards/s'))
+    print('%-10s %12.0f' % ('indexed', _ops_per_sec(run, discards)))
+
+def main():
+    bench_ordered_set()
+    print('')
+    bench_indexed_discards()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Micro benchmarks for utensils.stringutils. Run with:
+
+    python -m benchmarks.stringutils_bench
+"""
+import random
+import re
+import string
+import time
+import timeit
+import tracemalloc
+
+from utensils.stringutils import KeywordMatcher
+from utensils.stringutils import MATCH_AUTOMATON
+from utensils.stringutils import MATCH_REGEX
+from utensils.stringutils import MATCH_SCAN
+from utensils.stringutils import slugify
+
+def legacy_string_contains(string, keywords, lower=True, full_word=False):
+    """
+    Substring mode of string_contains as it was before keywords were
+    compiled, kept for comparison.
+    """
+    if not string:
+        return False
+    if lower:
+        string = string.lower()
+        words = [w.lower() for w in keywords]
+    return bool([w for w in words if w in string])
+
+def legacy_slugify(n):
+    n = re.sub(r'[^a-zA-Z0-9 ]', '', n)
+    n = re.sub(r'\s+', '-', n).lower()
+    return n
+
+def _random_word(generator):
+    return ''.join(generator.choice(string.ascii_lowercase)
+                   for _ in range(generator.randint(4, 10)))
+
+def _headlines(generator, keywords, count=1000):
+    # Mostly common words, with a keyword in roughly one in five headlines
+    common = ['the', 'and', 'market', 'news', 'today', 'report', 'shares']
+    headlines = []
+    for _ in range(count):
+        words = [generator.choice(common).title() for _ in range(10)]
+        if generator.random() < 0.2:
+            words[generator.randrange(10)] = generator.choice(keywords).title()
+        headlines.append(' '.join(words))
+    return headlines
+
+def _per_sec(fn, count, repeat=3):
+    return count / min(timeit.repeat(fn, number=1, repeat=repeat))
+
+def bench_keyword_matcher(sizes=(10, 1000, 50000)):
+    generator = random.Random(0)
+    print('%-8s %-10s %10s %10s %14s' % ('keywords', 'impl', 'build s',
+                                         'MB', 'headlines/s'))
+    for size in sizes:
+        keywords = [_random_word(generator) for _ in range(size)]
+        headlines = _headlines(generator, keywords)
+        expected = [legacy_string_contains(h, keywords) for h in headlines]
+        print('%-8s %-10s %10s %10s %14.0f' % (size, 'legacy', '-', '-', _per_sec(
+            lambda: [legacy_string_contains(h, keywords) for h in headlines],
+            len(headlines), repeat=1)))
+        for engine in (MATCH_SCAN, MATCH_AUTOMATON, MATCH_REGEX, None):
+            if engine == MATCH_SCAN and size > 1000:
+                continue
+            tracemalloc.start()
+            start = time.perf_counter()
+            matcher = KeywordMatcher(keywords, engine=engine)
+            build = time.perf_counter() - start
+            memory = tracemalloc.get_traced_memory()[0] / 1e6
+            tracemalloc.stop()
+            assert matcher.contains_many(headlines) == expected
+            label = engine or 'default'
+            print('%-8s %-10s %10.3f %10.1f %14.0f' % (size, label, build,
+                memory, _per_sec(lambda: matcher.contains_many(headlines),
+                                 len(headlines))))
+
+def bench_slugify(count=100000):
+    generator = random.Random(0)
+    words = ['Güzel', 'Kuşadası', 'News', '&amp;', 'Şehir', '&nbsp;', 'Ürün']
+    titles = [' '.join(generator.choice(words) for _ in range(8))
+              for _ in range(count)]
+    assert [legacy_slugify(t) for t in titles] == [slugify(t) for t in titles]
+    print('%-10s %14s' % ('slugify', 'titles/s'))
+    for label, fn in (('legacy', legacy_slugify), ('current', slugify)):
+        print('%-10s %14.0f' % (label, _per_sec(
+            lambda: [fn(t) for t in titles], count)))
+
+def main():
+    bench_keyword_matcher()
+    print('')
+    bench_slugify()
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,102 @@
 """A collection of dict tools.
 """
+from array import array
 from collections import OrderedDict
 from copy import copy
-import operator
+from functools import lru_cache
+from functools import reduce
+import heapq
+from itertools import chain
+from operator import itemgetter
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from utensils.stringutils import normalize
 
 ARRAY_ACCESSOR = re.compile(r'(.*)\[(.*?)\]')
 
-def flatten(dict_, key='children', children=[]):
+# Number of compiled paths kept around for get_dotted
+PATH_CACHE_SIZE = 1024
+
+# Step kinds of a compiled dotted path
+_KEY = 0
+_INDEX = 1
+_MATCH = 2
+_ALL = 3
+_INVALID = 4
+
+def flatten(dict_, key='children', children=None):
     """
     Flattens nested dictionaries that have a nesting structure based on key.
+    Note that key is removed from the nodes, see iter_flatten to keep the
+    tree intact.
 
     @param dict_: dict, starting with the parent node
     @param key: str, key on which to look for the children
     @return: list, list of children
     """
-    flat = []
-    if key in dict_:
-        for child in dict_[key]:
-            flat.extend(flatten(child, key))
-        del(dict_[key])
-    flat.append(dict_)
-    return flat
+    return list(iter_flatten(dict_, key))
+
+def _flatten_node(node, key, destructive):
+    if not destructive:
+        return dict_without_keys(node, [key])
+    if key in node:
+        del(node[key])
+    return node
+
+def iter_flatten(dict_, key='children', post_order=True, destructive=True,
+        with_info=False):
+    """
+    Lazily flattens nested dictionaries that have a nesting structure based
+    on key. Uses an explicit stack, so deep trees do not hit the recursion
+    limit.
+
+    @param dict_: dict, starting with the parent node
+    @param key: str, key on which to look for the children
+    @param post_order: bool, yield children before their parent (like
+    flatten) if True, and the parent first otherwise
+    @param destructive: bool, remove key from the nodes, like flatten. If
+    False the tree is left untouched, and shallow copies of the nodes without
+    key are yielded instead.
+    @param with_info: bool, yield (node, depth, parent) tuples, where depth
+    is 0 for dict_ and parent is the enclosing node in the tree (None for
+    dict_)
+    @return: Generator(dict)
+    """
+    def _emit(node, depth, parent):
+        node = _flatten_node(node, key, destructive)
+        return (node, depth, parent) if with_info else node
+
+    if post_order:
+        stack = [(dict_, iter(dict_.get(key) or ()), 0, None)]
+        while stack:
+            node, children, depth, parent = stack[-1]
+            for child in children:
+                stack.append((child, iter(child.get(key) or ()), depth + 1,
+                    node))
+                break
+            else:
+                stack.pop()
+                yield _emit(node, depth, parent)
+        return
+
+    # Grab the children before the node is yielded, as that removes them.
+    children = dict_.get(key) or ()
+    yield _emit(dict_, 0, None)
+    stack = [(iter(children), 1, dict_)]
+    while stack:
+        children, depth, parent = stack[-1]
+        for child in children:
+            grandchildren = child.get(key) or ()
+            yield _emit(child, depth, parent)
+            stack.append((iter(grandchildren), depth + 1, child))
+            break
+        else:
+            stack.pop()
 
 def inverse(dict_):
     """
@@ -32,18 +105,24 @@ def inverse(dict_):
     """
     return dict((v,k) for k, v in dict_.iteritems())
 
-def order(dict_, by_value=False, reverse=False):
+def order(dict_, by_value=False, reverse=False, limit=None,
+        dict_type=OrderedDict):
     """
     @param dict_: dict
     @param by_value: bool
+    @param limit: int, optional. Only keep the first limit items, which are
+    selected with a heap in O(n log limit) instead of sorting everything.
+    @param dict_type: type, type of the returned dict, e.g. dict
     @return: dict_
     """
-    def _getter(t):
-        return t[1] if by_value else t[0]
-    return OrderedDict(sorted(dict_.items(),
-        key=_getter,
-        reverse=reverse,
-        ))
+    key = itemgetter(1 if by_value else 0)
+    if limit is None:
+        items = sorted(dict_.items(), key=key, reverse=reverse)
+    elif reverse:
+        items = heapq.nlargest(limit, dict_.items(), key=key)
+    else:
+        items = heapq.nsmallest(limit, dict_.items(), key=key)
+    return dict_type(items)
 
 def transform(dict_, mapper, clone=False):
     """
@@ -62,6 +141,139 @@ def transform(dict_, mapper, clone=False):
         set_dotted(data, to_path, get_dotted(dict_, from_path))
     return data
 
+def _parse_accessor(accessor):
+    """
+    Parse an [N] or [@k=v] accessor.
+
+    @param accessor: str, e.g. '3' or '@bla=3'
+    @return: tuple(int, Object), (kind, argument)
+    @raise ValueError, IndexError: if the accessor is malformed
+    """
+    # Dict accessor
+    if "@" in accessor:
+        params = []
+        for pairs in accessor.split('@')[1:]:
+            value = pairs.split('=')[1]
+            params.append((pairs.split('=')[0], str(value),
+                normalize(str(value))))
+        return (_MATCH, tuple(params))
+    return (_INDEX, int(accessor))
+
+def _parse_component(component, remaining, delimiter='.'):
+    """
+    Parse a single component of a dotted path into a step. A malformed
+    accessor becomes an _INVALID step, which only raises if a lookup
+    reaches it, like get_dotted did before paths were compiled.
+
+    @param component: str, e.g. 'foo', 'foo[3]', 'foo[@bla=3]' or 'foo[*]'
+    @param remaining: list(str), components that follow this one
+    @param delimiter: str
+    @return: tuple(str, int, Object), (key, kind, argument)
+    """
+    match = re.match(ARRAY_ACCESSOR, component)
+    if not match:
+        return (component, _KEY, None)
+    component, accessor = match.group(1), match.group(2)
+    if not accessor:
+        return (component, _KEY, None)
+    # List accessor, the rest of the path is looked up on every element.
+    if "*" in accessor and "@" not in accessor:
+        return (component, _ALL, compile_path(delimiter.join(remaining)))
+    try:
+        kind, arg = _parse_accessor(accessor)
+    except (ValueError, IndexError):
+        return (component, _INVALID, accessor)
+    return (component, kind, arg)
+
+def _match_item(data, params, do_normalize=False):
+    """
+    Return the first item in data whose attributes match params, or data
+    itself (as a list) if none matches.
+    """
+    # Kind of hacky, but let's handle the case where this should
+    # be a list, but turns out a dict, such as in Gap's case.
+    data = data if isinstance(data, list) else [data]
+    for item in data:
+        for key, value, normalized in params:
+            if do_normalize:
+                if normalize(str(item[key])) != normalized:
+                    break
+            elif str(item[key]) != value:
+                break
+        # If we iterated over all the params, and did not break
+        # then we are good.
+        else:
+            return item
+    return data
+
+class DottedPath(object):
+    """
+    A dotted path that is parsed once, and can be used to look up values in
+    many dicts. Supports the same syntax as get_dotted.
+
+        path = compile_path('foo[@bla=3].bar')
+        path.get(data)
+    """
+    __slots__ = ('field', 'delimiter', 'steps')
+
+    def __init__(self, field, delimiter='.'):
+        """
+        @param field: str
+        @param delimiter: str
+        """
+        self.field = field
+        self.delimiter = delimiter
+        components = field.split(delimiter)
+        self.steps = tuple(
+                _parse_component(c, components[i + 1:], delimiter)
+                for i, c in enumerate(components))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.field)
+
+    def get(self, data, default=None, do_normalize=False):
+        """
+        @param data: dict
+        @param default: Object, returned if the path does not exist
+        @param do_normalize: bool, normalize values in [@k=v] comparisons
+        @return: Object
+        """
+        steps = self.steps
+        count = len(steps)
+        i = 0
+        while i < count and isinstance(data, dict):
+            component, kind, arg = steps[i]
+            i += 1
+            data = data.get(component)
+            if kind == _KEY:
+                continue
+            if kind == _INDEX:
+                data = data[arg]
+            elif kind == _MATCH:
+                data = _match_item(data, arg, do_normalize)
+            elif kind == _ALL:
+                return [arg.get(d) for d in data]
+            else:
+                # Raises the error of the malformed accessor
+                _parse_accessor(arg)
+
+        # If there are steps left, the final dest wasn't reached.
+        if i < count or data == None:
+            return default
+        return data
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def compile_path(field, delimiter='.'):
+    """
+    Parse a dotted path once so it can be reused across lookups. Compiled
+    paths are cached, so calling this repeatedly with the same path is cheap.
+
+    @param field: str
+    @param delimiter: str
+    @return: DottedPath
+    """
+    return DottedPath(field, delimiter)
+
 def get_dotted(data, field, default=None, delimiter='.',
         do_normalize=False,
         ):
@@ -74,56 +286,101 @@ def get_dotted(data, field, default=None, delimiter='.',
     Also allows array accessors:
         foo[@bla=3].bar: Choose the element in foo, whose attribute bla equals 3
         foo[3].bar: Choose index 3 in the foo array.
+        foo[*].bar: Collect bar from every element in the foo array.
 
     Note that it is type insensitive, i.e. in comparisions '3' and 3 will
     evaluate to the same.
+
+    Paths are compiled once and cached, see compile_path.
     """
-    components = field.split(delimiter)
-    components.reverse()
-    while components and isinstance(data, dict):
-        component = components.pop()
-        accessor = None
-        match = re.match(ARRAY_ACCESSOR, component)
-        if match:
-            component = match.group(1)
-            accessor = match.group(2)
-        data = data.get(component)
-        if accessor:
-            # Dict accessor
-            if "@" in accessor:
-                params = {}
-                for pairs in accessor.split('@')[1:]:
-                    params[pairs.split('=')[0]] = pairs.split('=')[1]
-                # Kind of hacky, but let's handle the case where this should
-                # be a list, but turns out a dict, such as in Gap's case.
-                data = data if isinstance(data, list) else [data]
-                for item in data:
-                    for key, value in params.items():
-                        if do_normalize:
-                            val1 = normalize(str(item[key]))
-                            val2 = normalize(str(value))
-                        else:
-                            val1 = str(item[key])
-                            val2 = str(value)
-                        if val1 != val2:
-                            break
-                    # If we iterated over all the params, and did not break
-                    # then we are good.
-                    else:
-                        data=item
-                        break
+    return compile_path(field, delimiter).get(data, default, do_normalize)
 
-            # List accessor
-            elif "*" in accessor:
-                cur_fields = delimiter.join(components[::-1])
-                return [get_dotted(d, cur_fields) for d in data]
-            else:
-                data = operator.getitem(data, int(accessor))
+def _build_path_tree(paths):
+    """
+    Build a shared-prefix tree of compiled paths, where each node is a list
+    of [step, column_indices, children] entries.
 
-    # If there are components left, the final dest wasn't reached.
-    if components or data == None:
-        return default
-    return data
+    @param paths: list(DottedPath)
+    @return: list
+    """
+    root = []
+    index = {id(root): {}}
+    for column, path in enumerate(paths):
+        node = root
+        for depth, step in enumerate(path.steps):
+            entries = index[id(node)]
+            entry = entries.get(step)
+            if entry is None:
+                entry = [step, [], []]
+                entries[step] = entry
+                node.append(entry)
+                index[id(entry[2])] = {}
+            # A [*] step resolves the rest of the path on its own.
+            if depth == len(path.steps) - 1 or step[1] == _ALL:
+                entry[1].append(column)
+                break
+            node = entry[2]
+    return root
+
+def _walk_path_tree(node, data, row):
+    """
+    Resolve every path in the tree against data, writing the values found
+    into row. Values follow the same rules as DottedPath.get.
+    """
+    for (component, kind, arg), columns, children in node:
+        value = data.get(component)
+        if kind == _INDEX:
+            value = value[arg]
+        elif kind == _MATCH:
+            value = _match_item(value, arg)
+        elif kind == _ALL:
+            value = [arg.get(d) for d in value]
+        elif kind == _INVALID:
+            _parse_accessor(arg)
+        if columns and value != None:
+            for column in columns:
+                row[column] = value
+        if children and isinstance(value, dict):
+            _walk_path_tree(children, value, row)
+
+def extract_columns(records, fields, default=None, dtype=None):
+    """
+    Pull several dotted fields out of a list of dicts in a single pass.
+    Paths sharing a prefix are only walked once per record. For example:
+        records = [{'a': {'b': 1, 'c': 2}}, {'a': {'b': 3}}]
+        extract_columns(records, ['a.b', 'a.c']) =>
+            {'a.b': [1, 3], 'a.c': [2, None]}
+
+    @param records: iterable(dict)
+    @param fields: list(str), paths as accepted by get_dotted
+    @param default: Object, used when a path does not exist in a record.
+    Required with dtype, since missing values are filled in with it before
+    the conversion.
+    @param dtype: str, optional. If given, columns are returned as numpy
+    arrays of that dtype, or as array.array with dtype as the typecode if
+    numpy is not installed.
+    @return: dict(str, list), or dict(str, numpy.ndarray|array.array) if
+    dtype is given
+    """
+    if dtype is not None and default is None:
+        raise ValueError('extract_columns needs a default to fill missing '
+                'values with when dtype is given')
+    fields = list(fields)
+    tree = _build_path_tree([compile_path(field) for field in fields])
+    columns = [[] for _ in fields]
+    defaults = [default] * len(fields)
+    for record in records:
+        row = list(defaults)
+        if isinstance(record, dict):
+            _walk_path_tree(tree, record, row)
+        for column, value in zip(columns, row):
+            column.append(value)
+    if dtype is not None:
+        if numpy is not None:
+            columns = [numpy.array(column, dtype=dtype) for column in columns]
+        else:
+            columns = [array(dtype, column) for column in columns]
+    return dict(zip(fields, columns))
 
 def set_dotted(data, field, value, delimiter='.'):
     """Set a nested subfield inside data using Mongo style dotted notation
@@ -132,33 +389,233 @@ def set_dotted(data, field, value, delimiter='.'):
         set_dotted_field(data, 'b.d.e', 4)
         data == {'a': 1, 'b': {'c': 2, 'd': {'e': 4}}}
     """
-    if not delimiter in field:
-        data[field] = value
-    else:
-        next_field, remaining_fields = field.split(delimiter, 1)
+    _set_components(data, field.split(delimiter), value)
+
+def _set_components(data, components, value):
+    """
+    Set value inside data following the already split path components,
+    creating intermediate dicts as needed.
+    """
+    for component in components[:-1]:
+        # If component isn't there, create it so we can move on.
+        if component not in data:
+            data[component] = {}
+        data = data[component]
+    data[components[-1]] = value
 
-        # If next_field isn't there, create it so we can move on.
-        if next_field not in data:
-            data[next_field] = {}
+def _build_target_tree(steps):
+    """
+    Build a shared-prefix tree of the target paths, where each node is a
+    list of [key, source_path, children] entries. Returns None if a target
+    path is a prefix of another one, in which case the mapping has to be
+    applied sequentially.
 
-        set_dotted(data[next_field], remaining_fields, value, delimiter=delimiter)
+    @param steps: list(tuple(DottedPath, tuple(str)))
+    @return: list|None
+    """
+    root = []
+    index = {id(root): {}}
+    for source, target in steps:
+        node = root
+        for depth, component in enumerate(target):
+            entries = index[id(node)]
+            is_leaf = depth == len(target) - 1
+            entry = entries.get(component)
+            if entry is None:
+                entry = [component, None, None if is_leaf else []]
+                entries[component] = entry
+                node.append(entry)
+                if not is_leaf:
+                    index[id(entry[2])] = {}
+            elif (entry[2] is None) != is_leaf:
+                return None
+            if is_leaf:
+                # Later mappings to the same target win, like set_dotted.
+                entry[1] = source
+            else:
+                node = entry[2]
+    return root
+
+def _fill_target_tree(node, dict_):
+    data = {}
+    for key, source, children in node:
+        if children is None:
+            data[key] = source.get(dict_)
+        else:
+            data[key] = _fill_target_tree(children, dict_)
+    return data
+
+class TransformPlan(object):
+    """
+    A mapper for transform that is parsed once, so it can be applied to many
+    dicts. See compile_transform.
+    """
+    __slots__ = ('mapper', 'clone', 'steps', 'tree')
+
+    def __init__(self, mapper, clone=False):
+        """
+        @param mapper: dict(str, str), source path -> target path
+        @param clone: bool, see transform
+        """
+        self.mapper = dict(mapper)
+        self.clone = clone
+        self.steps = tuple((compile_path(from_path), tuple(to_path.split('.')))
+                for from_path, to_path in mapper.items())
+        # Writing into a clone of the source has to happen in order, since
+        # the clone shares nested dicts with the source.
+        self.tree = None if clone else _build_target_tree(self.steps)
+
+    def __repr__(self):
+        return '%s(%r, clone=%r)' % (self.__class__.__name__, self.mapper,
+                self.clone)
+
+    def apply(self, dict_):
+        """
+        @param dict_: dict
+        @return: dict, same as transform(dict_, mapper, clone)
+        """
+        if self.tree is not None:
+            return _fill_target_tree(self.tree, dict_)
+        data = copy(dict_) if self.clone else {}
+        for source, target in self.steps:
+            _set_components(data, target, source.get(dict_))
+        return data
+
+def compile_transform(mapper, clone=False):
+    """
+    Parse the source and target paths of a transform mapper once, so it can
+    be applied to a stream of dicts.
+
+        plan = compile_transform({'a.b': 'c', 'd[0]': 'e.f'})
+        plan.apply(dict_) == transform(dict_, {'a.b': 'c', 'd[0]': 'e.f'})
+
+    @param mapper: dict(str, str)
+    @param clone: bool, see transform
+    @return: TransformPlan
+    """
+    return TransformPlan(mapper, clone=clone)
+
+def transform_many(iterable, plan):
+    """
+    Lazily transform every dict in iterable.
+
+    @param iterable: iterable(dict)
+    @param plan: TransformPlan|dict, a compiled plan or a mapper
+    @return: Generator(dict)
+    """
+    if not isinstance(plan, TransformPlan):
+        plan = compile_transform(plan)
+    apply = plan.apply
+    for dict_ in iterable:
+        yield apply(dict_)
+
+# Modes of apply_to_dict
+APPLY_COPY = 'copy'
+APPLY_COPY_ON_WRITE = 'cow'
+APPLY_IN_PLACE = 'inplace'
+APPLY_MODES = (APPLY_COPY, APPLY_COPY_ON_WRITE, APPLY_IN_PLACE)
 
 def unicode_keys(data):
     return apply_to_dict(data,
-                         lambda x: unicode(x) if isinstance(x,str) else x)
-
-def apply_to_dict(data, _function):
-    if type(data) == dict:
-        data = dict(data) # copy it first
-        for key in data:
-            data[key] = apply_to_dict(data[key], _function)
-    elif type(data) == list:
-        data = list(data) # copy it first
-        for i, item in enumerate(data):
-            data[i] = apply_to_dict(item, _function)
+                         lambda x: str(x) if isinstance(x,str) else x)
+
+def _start_apply_frame(container, key, mode, key_function):
+    """
+    @return: list, [container, items, key, result, pairs]
+    """
+    if type(container) == dict:
+        items = iter(container.items())
+        # Keys may change, so the dict is rebuilt from its pairs.
+        pairs = [] if key_function else None
     else:
-        data = _function(data)
-    return data
+        items = enumerate(container)
+        pairs = None
+    if mode == APPLY_IN_PLACE:
+        result = container
+    elif mode == APPLY_COPY and pairs is None:
+        result = container.copy()
+    else:
+        result = None
+    return [container, items, key, result, pairs]
+
+def _set_apply_pair(frame, key, value, new_value, key_function):
+    """
+    Record the mapped key and new value in a frame whose keys are mapped.
+    """
+    new_key = key_function(key)
+    frame[4].append((new_key, new_value))
+    # For copy on write, result only marks that something changed.
+    if frame[3] is None and (new_value is not value or new_key != key):
+        frame[3] = True
+
+def _finish_apply_frame(frame, mode):
+    """
+    Build the new dict of a frame whose keys were mapped.
+    """
+    container, _, _, result, pairs = frame
+    if mode == APPLY_IN_PLACE:
+        container.clear()
+        container.update(pairs)
+        return container
+    if mode == APPLY_COPY_ON_WRITE and result is None:
+        return container
+    return dict(pairs)
+
+def apply_to_dict(data, _function, mode=APPLY_COPY, key_function=None):
+    """
+    Apply _function to every leaf (anything but a dict or a list) nested
+    inside data. Walks data with an explicit stack, so deep documents do not
+    hit the recursion limit.
+
+    @param data: dict|list|Object
+    @param _function: func, applied to every leaf
+    @param mode: str, one of
+        APPLY_COPY: return a copy of every dict and list (the default)
+        APPLY_COPY_ON_WRITE: only copy dicts and lists that contain a leaf
+        (or key) that changed, everything else is shared with data
+        APPLY_IN_PLACE: modify data itself
+    A leaf counts as changed if _function returns a different object.
+    @param key_function: func, optional. Applied to every dict key.
+    @return: dict|list|Object
+    """
+    if mode not in APPLY_MODES:
+        raise ValueError('unknown mode: %s' % mode)
+    if type(data) != dict and type(data) != list:
+        return _function(data)
+    stack = [_start_apply_frame(data, None, mode, key_function)]
+    while True:
+        frame = stack[-1]
+        pairs = frame[4]
+        for key, value in frame[1]:
+            if type(value) == dict or type(value) == list:
+                stack.append(_start_apply_frame(value, key, mode, key_function))
+                break
+            new_value = _function(value)
+            if pairs is not None:
+                _set_apply_pair(frame, key, value, new_value, key_function)
+            elif new_value is not value:
+                result = frame[3]
+                if result is None:
+                    result = frame[3] = frame[0].copy()
+                result[key] = new_value
+        else:
+            stack.pop()
+            value = frame[0]
+            if frame[4] is None:
+                new_value = value if frame[3] is None else frame[3]
+            else:
+                new_value = _finish_apply_frame(frame, mode)
+            if not stack:
+                return new_value
+            parent = stack[-1]
+            if parent[4] is not None:
+                _set_apply_pair(parent, frame[2], value, new_value,
+                        key_function)
+            elif new_value is not value:
+                result = parent[3]
+                if result is None:
+                    result = parent[3] = parent[0].copy()
+                result[frame[2]] = new_value
 
 def replace_unicode_keys(data, recurse=False):
     """ Convert top-level unicode strings to regular strings so the
@@ -186,7 +643,7 @@ def dict_without_keys(src_dict, keys_to_exclude):
         be in the src_dict. They'll be ignored if they're not.
     @return: A copy of src_dict without keys_to_exclude.
     """
-    return dict( (key, value) for key, value in src_dict.iteritems() if key not in keys_to_exclude )
+    return dict( (key, value) for key, value in src_dict.items() if key not in keys_to_exclude )
 
 def get_from_list(items, key, value, default=None):
     """Get an item from a list of collections based on a key/value.
@@ -227,6 +684,55 @@ def to_dict_by_key(col, key_key, value_key=None, include_key=False):
     else:
         return dict( (item[key_key], item) for item in col if key_key in item )
 
+def group_by_key(col, key, value_key=None, include_key=True):
+    """
+    Group a list of collections into a dict of lists by a key in the items,
+    in a single pass. Unlike to_dict_by_key, items sharing a key are all
+    kept, and by default the items themselves are shared instead of copied.
+    Ex:
+      col = [{'k': 'a', 'n': 1}, {'k': 'b', 'n': 2}, {'k': 'a', 'n': 3}]
+      group_by_key(col, 'k') --> {'a': [{'k': 'a', 'n': 1}, {'k': 'a', 'n': 3}],
+                                  'b': [{'k': 'b', 'n': 2}]}
+      group_by_key(col, 'k', 'n') --> {'a': [1, 3], 'b': [2]}
+
+    Items that don't contain key are ignored. Both key and value_key may be
+    dotted paths, as accepted by get_dotted, in which case items where key
+    resolves to None are ignored too.
+
+    @param col: collection, Collection to group.
+    @param key: str, Key to look for in items and turn into keys in resulting dict.
+    @param value_key: str, Key to look for in items and turn into values in
+        resulting dict. Values are None for items that don't contain it.
+    @param include_key: bool, if False, copy items without key, like
+        to_dict_by_key does.
+    @return: dict(Object, list)
+    """
+    plain_key = '.' not in key and '[' not in key
+    path = compile_path(key)
+    value_path = compile_path(value_key) if value_key is not None else None
+    groups = {}
+    for item in col:
+        if plain_key:
+            if key not in item:
+                continue
+            cur_key = item[key]
+        else:
+            cur_key = path.get(item)
+            if cur_key == None:
+                continue
+        if value_path is not None:
+            value = value_path.get(item)
+        elif include_key:
+            value = item
+        else:
+            value = dict_without_keys(item, [key])
+        group = groups.get(cur_key)
+        if group is None:
+            groups[cur_key] = [value]
+        else:
+            group.append(value)
+    return groups
+
 def combine_dicts(dicts, fn=lambda values: sum(values), default=None):
     """Combine values of multiple dicts into one using a function.
     If no default is given, keys that are missing from one or more dicts are
@@ -250,6 +756,158 @@ def combine_dicts(dicts, fn=lambda values: sum(values), default=None):
         all_keys = reduce(lambda a,b: set(a).union(b), (d.keys() for d in dicts))
         return dict( (key, fn([d.get(key, default) for d in dicts])) for key in all_keys )
 
+class Reducer(object):
+    """
+    An associative reducer for combine_dicts_iter: values are folded into an
+    accumulator one at a time.
+    """
+    __slots__ = ('name', 'init', 'fold', 'finish', 'idempotent')
+
+    def __init__(self, fold, init=None, finish=None, idempotent=False,
+            name=None):
+        """
+        @param fold: func(acc, value), return the new accumulator
+        @param init: func(value), accumulator for the first value. Defaults to
+        the value itself.
+        @param finish: func(acc), final result. Defaults to acc.
+        @param idempotent: bool, folding the same value twice is the same as
+        folding it once (e.g. min and max)
+        @param name: str
+        """
+        self.fold = fold
+        self.init = init or (lambda value: value)
+        self.finish = finish
+        self.idempotent = idempotent
+        self.name = name
+
+    def fold_n(self, acc, value, n):
+        """
+        Fold value into acc n times.
+        """
+        if self.idempotent:
+            return self.fold(acc, value) if n else acc
+        for _ in range(n):
+            acc = self.fold(acc, value)
+        return acc
+
+REDUCERS = {
+    'sum': Reducer(lambda acc, value: acc + value, name='sum'),
+    'min': Reducer(min, idempotent=True, name='min'),
+    'max': Reducer(max, idempotent=True, name='max'),
+    'count': Reducer(lambda acc, value: acc + 1, init=lambda value: 1,
+        name='count'),
+    'mean': Reducer(lambda acc, value: (acc[0] + value, acc[1] + 1),
+        init=lambda value: (value, 1),
+        finish=lambda acc: float(acc[0]) / acc[1],
+        name='mean'),
+    }
+
+def _get_reducer(reducer):
+    """
+    @param reducer: str|Reducer|func(acc, value)
+    @return: Reducer
+    """
+    if isinstance(reducer, Reducer):
+        return reducer
+    if callable(reducer):
+        return Reducer(reducer)
+    if reducer not in REDUCERS:
+        raise ValueError('unknown reducer: %s' % reducer)
+    return REDUCERS[reducer]
+
+def _combine_dicts_numpy(dicts, reducer, default=None):
+    """
+    combine_dicts_iter for the builtin reducers, aligning all dicts on a
+    shared key index and reducing them as a 2-D array.
+    """
+    dicts = list(dicts)
+    if not dicts:
+        return {}
+    keys = list(dict.fromkeys(chain.from_iterable(dicts)))
+    index = dict(zip(keys, range(len(keys))))
+    rows = [numpy.array(list(d.values())) for d in dicts]
+    fill = 0 if default == None else default
+    # Empty dicts give float rows, which must not decide the dtype.
+    matrix = numpy.full((len(dicts), len(keys)), fill,
+            dtype=numpy.result_type(fill, *[row for row in rows if row.size]))
+    present = numpy.zeros(len(keys), dtype=numpy.intp)
+    for i, d in enumerate(dicts):
+        columns = numpy.fromiter(map(index.__getitem__, d), dtype=numpy.intp,
+                count=len(d))
+        matrix[i, columns] = rows[i]
+        present[columns] += 1
+    if reducer.name == 'count':
+        reduced = numpy.full(len(keys), len(dicts))
+    else:
+        reduced = getattr(matrix, reducer.name)(axis=0)
+    if default == None:
+        # Keys that are missing from one or more dicts are ignored.
+        mask = present == len(dicts)
+        keys = [key for key, keep in zip(keys, mask) if keep]
+        reduced = reduced[mask]
+    return dict(zip(keys, reduced.tolist()))
+
+def combine_dicts_iter(dicts, reducer='sum', default=None, use_numpy=False):
+    """
+    Combine values of multiple dicts into one in a single pass, folding in
+    one dict at a time, so dicts can be a generator that is never fully
+    materialized. Has the same semantics as combine_dicts: if no default is
+    given, keys that are missing from one or more dicts are ignored.
+
+        combine_dicts_iter(counters) == combine_dicts(counters, fn=sum)
+
+    @param dicts: iterable(dict)
+    @param reducer: str|Reducer|func(acc, value), one of 'sum', 'min', 'max',
+    'count' and 'mean', or a Reducer, or an associative two argument function
+    @param default: For dicts that don't have a particular key, use this value
+        in the reduction. If default == None, ignore the entire key.
+    @param use_numpy: bool, for the builtin reducers and numeric values, align
+    the dicts into a 2-D numpy array and reduce that instead. This buffers all
+    the dicts. Ignored if numpy is not installed.
+    @return: dict
+    """
+    reducer = _get_reducer(reducer)
+    if (use_numpy and numpy is not None
+            and reducer is REDUCERS.get(reducer.name)):
+        return _combine_dicts_numpy(dicts, reducer, default)
+    init, fold = reducer.init, reducer.fold
+    acc = None
+    if default == None:
+        for d in dicts:
+            if acc is None:
+                acc = dict((key, init(value)) for key, value in d.items())
+            else:
+                acc = dict((key, fold(cur, d[key]))
+                        for key, cur in acc.items() if key in d)
+    else:
+        # Number of dicts folded into each key so far. The default is only
+        # folded in when a key shows up again, or at the end.
+        acc = {}
+        counts = {}
+        n = 0
+        for d in dicts:
+            for key, value in d.items():
+                count = counts.get(key)
+                if count is None:
+                    if n:
+                        cur = reducer.fold_n(init(default), default, n - 1)
+                        acc[key] = fold(cur, value)
+                    else:
+                        acc[key] = init(value)
+                else:
+                    acc[key] = fold(reducer.fold_n(acc[key], default,
+                        n - count), value)
+                counts[key] = n + 1
+            n += 1
+        for key, count in counts.items():
+            if count < n:
+                acc[key] = reducer.fold_n(acc[key], default, n - count)
+    if not acc:
+        return {}
+    if reducer.finish:
+        return dict((key, reducer.finish(value)) for key, value in acc.items())
+    return acc
+
 def deep_items(d, delimeter='.'):
     """
     Travsere the dict (which could be a dict of dicts) and return a list of
@@ -259,14 +917,46 @@ def deep_items(d, delimeter='.'):
     @param delimterer: str, optional.
     @return: list(str, Object)
     """
-    pairs = []
-    for k, v in d.items():
-        if isinstance(v, dict):
-            cur_pairs = deep_items(v, delimeter)
-            pairs.extend([(k + delimeter + cur_k, cur_v) for (cur_k, cur_v) in cur_pairs])
+    return list(iter_deep_items(d, delimeter))
+
+def iter_deep_items(d, delimeter='.', tuple_paths=False, lists=False):
+    """
+    Lazily traverse the dict (which could be a dict of dicts) and yield path,
+    value pairs, in the same order as deep_items. Uses an explicit stack, so
+    arbitrarily deep dicts do not hit the recursion limit. For example:
+        d = {'a': {'b': 1, 'c': [2, {'d': 3}]}}
+        list(iter_deep_items(d)) => [('a.b', 1), ('a.c', [2, {'d': 3}])]
+        list(iter_deep_items(d, lists=True)) =>
+            [('a.b', 1), ('a.c[0]', 2), ('a.c[1].d', 3)]
+        list(iter_deep_items(d, tuple_paths=True)) =>
+            [(('a', 'b'), 1), (('a', 'c'), [2, {'d': 3}])]
+
+    @param d: dict
+    @param delimeter: str, optional.
+    @param tuple_paths: bool, yield paths as tuples of keys (and list indices)
+    instead of joined strings.
+    @param lists: bool, also descend into lists, using [i] for the indices.
+    @return: Generator(str|tuple, Object)
+    """
+    stack = [(iter(d.items()), None, False)]
+    while stack:
+        items, prefix, in_list = stack[-1]
+        for k, v in items:
+            if tuple_paths:
+                path = (k,) if prefix is None else prefix + (k,)
+            elif in_list:
+                path = '%s[%d]' % (prefix, k)
+            else:
+                path = k if prefix is None else prefix + delimeter + k
+            if isinstance(v, dict):
+                stack.append((iter(v.items()), path, False))
+                break
+            if lists and isinstance(v, list):
+                stack.append((enumerate(v), path, True))
+                break
+            yield path, v
         else:
-            pairs.append((k, v))
-    return pairs
+            stack.pop()
 
 def get_value_for_key(data, key):
     """
@@ -289,3 +979,136 @@ def get_value_for_key(data, key):
             if to_return:
                 return to_return
     return None
+
+def _iter_container(data):
+    """
+    @return: tuple(iterator, bool), iterator over the (key, value) pairs of
+    a dict or the (index, item) pairs of a list, and whether data is a dict
+    """
+    if isinstance(data, dict):
+        return iter(data.items()), True
+    return enumerate(data), False
+
+def _iter_key_paths(data, prefix=()):
+    """
+    Yield (key, path, value) for every dict key nested inside data, in the
+    order get_value_for_key visits them. Paths are tuples of dict keys and
+    list indices.
+    """
+    if not isinstance(data, (dict, list)):
+        return
+    stack = [_iter_container(data) + (prefix,)]
+    while stack:
+        items, in_dict, prefix = stack[-1]
+        for key, val in items:
+            path = prefix + (key,)
+            if in_dict:
+                yield key, path, val
+            if isinstance(val, (dict, list)):
+                stack.append(_iter_container(val) + (path,))
+                break
+        else:
+            stack.pop()
+
+class KeyIndex(object):
+    """
+    Index of every key nested inside a dict, for answering many
+    get_value_for_key style lookups against the same document. Unlike
+    get_value_for_key, falsy values (0, '', []) count as matches.
+
+        index = KeyIndex(data)
+        index.first('gar') => 3
+        index.paths('gar') => [('foo', 0, 'gar')]
+
+    Matches are kept in document order. Keys added by update() come after
+    the ones that were indexed before them.
+    """
+
+    def __init__(self, data):
+        """
+        @param data: dict
+        """
+        self.data = data
+        self._index = {}
+        self._add(data, ())
+
+    def _add(self, data, prefix):
+        index = self._index
+        for key, path, val in _iter_key_paths(data, prefix):
+            paths = index.get(key)
+            if paths is None:
+                paths = index[key] = {}
+            paths[path] = val
+
+    def _remove(self, data, prefix):
+        index = self._index
+        for key, path, _ in _iter_key_paths(data, prefix):
+            paths = index[key]
+            del paths[path]
+            if not paths:
+                del index[key]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def first(self, key, default=None):
+        """
+        @param key: str
+        @param default: Object, returned if key is not in the document
+        @return: Object, value of the first occurrence of key
+        """
+        paths = self._index.get(key)
+        if not paths:
+            return default
+        return next(iter(paths.values()))
+
+    def all(self, key):
+        """
+        @param key: str
+        @return: list(Object), values of every occurrence of key
+        """
+        return list(self._index.get(key, {}).values())
+
+    def paths(self, key):
+        """
+        @param key: str
+        @return: list(tuple), paths of every occurrence of key
+        """
+        return list(self._index.get(key, {}))
+
+    def items(self, key):
+        """
+        @param key: str
+        @return: list(tuple(tuple, Object)), (path, value) of every
+        occurrence of key
+        """
+        return list(self._index.get(key, {}).items())
+
+    def update(self, path, value):
+        """
+        Replace the subtree at path with value, both in the document and in
+        the index.
+
+        @param path: tuple, dict keys and list indices, as returned by paths
+        @param value: Object
+        """
+        path = tuple(path)
+        parent = self.data
+        for key in path[:-1]:
+            parent = parent[key]
+        key = path[-1]
+        if isinstance(parent, dict):
+            if key in parent:
+                self._remove(parent[key], path)
+            # Keep the position of the replaced key itself.
+            paths = self._index.get(key)
+            if paths is None:
+                paths = self._index[key] = {}
+            paths[path] = value
+        else:
+            self._remove(parent[key], path)
+        parent[key] = value
+        self._add(value, path)
@@ -1,14 +1,42 @@
+import asyncio
+import collections.abc
+from bisect import bisect_right
 from collections import defaultdict
-from itertools import cycle
+from collections import deque
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import Executor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from itertools import accumulate
+from itertools import count
+from itertools import filterfalse
 from itertools import islice
 from itertools import groupby
+import hashlib
 import logging
+import math
+import operator
+import os
 import random
+import time
+import weakref
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def shuffle_multi(*args, **kwargs):
     """
     Shuffle function that does not do in place, and can have a determenistic
-    seed.
+    seed. All the lists are shuffled with the same permutation. Uses a
+    private random generator, so the global random module is not touched.
+
+    If numpy is installed and the lists are numpy arrays, they are shuffled
+    with numpy, and numpy arrays are returned.
 
     @param items: list(int)
     @param seed: int
@@ -21,22 +49,31 @@ def shuffle_multi(*args, **kwargs):
     if not len(args[0]):
         return args
     seed = kwargs.get('seed')
-    generator = random.Random()
-    generator.seed(seed)
-    to_return = zip(*[t[1] for t in sorted((generator.random(), i) for i in zip(*args))])
-    return [list(t) for t in to_return]
+    if numpy is not None and all(isinstance(a, numpy.ndarray) for a in args):
+        indices = numpy.random.RandomState(seed).permutation(len(args[0]))
+        return [a[indices] for a in args]
+    indices = list(range(len(args[0])))
+    random.Random(seed).shuffle(indices)
+    return [[a[i] for i in indices] for a in args]
 
 def shuffle(items, seed=None):
     """
     Shuffle function that does not do in place, and can have a determenistic
-    seed.
+    seed. Uses a private random generator, so the global random module is not
+    touched.
+
+    If numpy is installed and items is a numpy array, it is shuffled with
+    numpy, and a numpy array is returned.
 
     @param items: list(int)
     @param seed: int
     @return: list(int)
     """
-    random.seed(seed)
-    return [t[1] for t in sorted((random.random(), i) for i in items)]
+    if numpy is not None and isinstance(items, numpy.ndarray):
+        return numpy.random.RandomState(seed).permutation(items)
+    items = list(items)
+    random.Random(seed).shuffle(items)
+    return items
 
 def merge(list_1, list_2, mix_percentage=0):
     """
@@ -52,6 +89,52 @@ def merge(list_1, list_2, mix_percentage=0):
             shuffle(list_1[cutoff_1:] + list_2[cutoff_2:])
             )
 
+def merge_iter(it_1, it_2, mix_percentage=0, seed=None):
+    """
+    Lazy version of merge, for iterables of unknown length. Items are
+    interleaved on the fly, each one coming from it_2 with a probability of
+    mix_percentage / 100 (as long as both have items left).
+
+    @param it_1: iterable
+    @param it_2: iterable
+    @param mix_percentage: int, [0-100], if 0, it_1 comes first, if 100,
+    it_2 comes first, ow, it's a mix
+    @param seed: int
+    @return: Generator
+    """
+    mix = float(mix_percentage) / 100
+    return weighted_merge_iter([it_1, it_2], [1 - mix, mix], seed=seed)
+
+def weighted_merge_iter(iterables, weights, seed=None):
+    """
+    Lazily interleave any number of iterables, picking the source of each
+    item at random in proportion to its weight among the sources that still
+    have items. Sources with a weight of 0 are only used once all the others
+    are exhausted, in order. Only one item per source is in flight at a time.
+
+    @param iterables: list(iterable)
+    @param weights: list(float)
+    @param seed: int
+    @return: Generator
+    """
+    assert(len(iterables) == len(weights))
+    generator = random.Random(seed)
+    sources = [iter(it) for it in iterables]
+    weights = list(weights)
+    cumulative = list(accumulate(weights))
+    while sources:
+        total = cumulative[-1]
+        idx = 0
+        if total > 0:
+            idx = min(bisect_right(cumulative, generator.random() * total),
+                    len(sources) - 1)
+        try:
+            yield next(sources[idx])
+        except StopIteration:
+            del sources[idx]
+            del weights[idx]
+            cumulative = list(accumulate(weights))
+
 def push_to_front(l, filter_fn):
     """
     Push the first matching item to the first of the list
@@ -61,7 +144,7 @@ def push_to_front(l, filter_fn):
     @return: list
     """
     idx = find(l, filter_fn)
-    if not idx:
+    if idx is None or idx == 0:
         return l
     return [l[idx]] + l[:idx] + l[idx+1:]
 
@@ -78,24 +161,378 @@ def find(l, filter_fn):
             return idx
     return None
 
-def batch(arr, size):
-    cur_arr = []
+def _promote_positions(items, positions):
+    """
+    Yield items at the sorted positions, then the rest of items in order.
+    """
+    for idx in positions:
+        yield items[idx]
+    it = iter(items)
+    start = 0
+    for idx in positions:
+        for item in islice(it, idx - start):
+            yield item
+        next(it, None)
+        start = idx + 1
+    for item in it:
+        yield item
+
+def promote(items, predicate_or_key, limit=1):
+    """
+    Lazily yield the first limit matching items, followed by the rest in
+    their original order. Only the items before the last promoted match are
+    buffered, items is not copied.
+
+    @param items: iterable|ListIndex
+    @param predicate_or_key: func, or a (name, value) pair when items is a
+        ListIndex
+    @param limit: int, None promotes every match
+    @return: generator
+    """
+    if isinstance(items, ListIndex):
+        name, value = predicate_or_key
+        return items.promote(name, value, limit=limit)
+    return _promote_iter(items, predicate_or_key, limit)
+
+def _promote_iter(items, predicate, limit):
+    it = iter(items)
+    matches = []
+    skipped = []
+    if limit is None or limit > 0:
+        for item in it:
+            if predicate(item):
+                matches.append(item)
+                if limit is not None and len(matches) >= limit:
+                    break
+            else:
+                skipped.append(item)
+    for item in matches:
+        yield item
+    for item in skipped:
+        yield item
+    for item in it:
+        yield item
+
+class ListIndex(object):
+    """
+    Precomputed value -> positions maps over a list, one per named key
+    function, so that repeated lookups are O(1) instead of a scan per call.
+    The index is a snapshot: rebuild it if the list changes.
+
+    >>> index = ListIndex(users, {'id': lambda u: u.id})
+    >>> index.get('id', 42)
+    """
+
+    def __init__(self, l, key_fns):
+        """
+        @param l: list
+        @param key_fns: dict, name -> func returning a hashable key
+        """
+        self.items = l if isinstance(l, Sequence) else list(l)
+        self.key_fns = dict(key_fns)
+        self._positions = {}
+        for name, key_fn in self.key_fns.items():
+            positions = defaultdict(list)
+            for idx, item in enumerate(self.items):
+                positions[key_fn(item)].append(idx)
+            self._positions[name] = dict(positions)
+
+    def find(self, name, value):
+        """
+        @return: int|None, position of the first item whose key is value
+        """
+        positions = self._positions[name].get(value)
+        return positions[0] if positions else None
+
+    def find_all(self, name, value):
+        """
+        @return: list(int), positions of the items whose key is value
+        """
+        return list(self._positions[name].get(value, ()))
+
+    def get(self, name, value, default=None):
+        """
+        @return: the first item whose key is value, else default
+        """
+        idx = self.find(name, value)
+        return default if idx is None else self.items[idx]
+
+    def promote(self, name, value, limit=1):
+        """
+        Lazily yield the first limit items whose key is value, followed by
+        the rest of the list in order.
+
+        @return: generator
+        """
+        positions = self._positions[name].get(value, [])
+        return _promote_positions(self.items, positions[:limit])
+
+    def push_to_front(self, name, value):
+        """
+        Indexed push_to_front.
+
+        @return: list
+        """
+        idx = self.find(name, value)
+        if idx is None or idx == 0:
+            return self.items
+        return list(self.promote(name, value))
+
+class _BatchBuilder(object):
+    """
+    Accumulates items into a batch until it is cut by count, cumulative size
+    or age.
+    """
+    __slots__ = ('size', 'max_bytes', 'size_fn', 'max_wait', 'items',
+            'bytes', 'started')
+
+    def __init__(self, size=None, max_bytes=None, size_fn=None, max_wait=None):
+        if size is None and max_bytes is None and max_wait is None:
+            raise ValueError('one of size, max_bytes or max_wait is required')
+        self.size = size
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn or len
+        self.max_wait = max_wait
+        self.items = []
+        self.bytes = 0
+        self.started = None
+
+    def expired(self):
+        return (self.max_wait is not None and
+                time.monotonic() - self.started >= self.max_wait)
+
+    def add(self, item):
+        """
+        @return: list(list), batches that are complete after adding item
+        """
+        ready = []
+        if self.max_bytes is not None:
+            item_bytes = self.size_fn(item)
+            # Cut before going over max_bytes, unless the batch is empty.
+            if self.items and self.bytes + item_bytes > self.max_bytes:
+                ready.append(self.flush())
+            self.bytes += item_bytes
+        if not self.items:
+            self.started = time.monotonic()
+        self.items.append(item)
+        if ((self.size is not None and len(self.items) >= self.size) or
+                (self.max_bytes is not None and self.bytes >= self.max_bytes) or
+                self.expired()):
+            ready.append(self.flush())
+        return ready
+
+    def flush(self):
+        items = self.items
+        self.items = []
+        self.bytes = 0
+        self.started = None
+        return items
+
+def batch(arr, size=None, max_bytes=None, size_fn=None, max_wait=None):
+    """
+    Break arr into lists of items. A batch is cut as soon as any of the
+    given limits is reached.
+
+    @param arr: iterable
+    @param size: int, max number of items in a batch
+    @param max_bytes: int, max cumulative size_fn(item) of a batch. Only
+    goes over if a single item is bigger than max_bytes.
+    @param size_fn: func, size of an item for max_bytes, defaults to len
+    @param max_wait: float, seconds. Cut a batch once it has been open for
+    that long. As arr is consumed synchronously, this is only checked when
+    an item arrives, see abatch for a strict bound.
+    @return: Generator(list)
+    """
+    if max_bytes is None and max_wait is None and size is not None:
+        size = max(size, 1)
+        # Slicing a sequence is much cheaper than appending item by item.
+        if isinstance(arr, Sequence):
+            for idx in range(0, len(arr), size):
+                cur_arr = arr[idx:idx + size]
+                yield cur_arr if type(cur_arr) == list else list(cur_arr)
+            return
+        it = iter(arr)
+        cur_arr = list(islice(it, size))
+        while cur_arr:
+            yield cur_arr
+            cur_arr = list(islice(it, size))
+        return
+    builder = _BatchBuilder(size, max_bytes, size_fn, max_wait)
     for item in arr:
-        cur_arr.append(item)
-        if len(cur_arr) >= size:
+        for cur_arr in builder.add(item):
+            yield cur_arr
+    if builder.items:
+        yield builder.flush()
+
+async def abatch(aiterable, size=None, max_bytes=None, size_fn=None,
+        max_wait=None):
+    """
+    Async version of batch, for async iterables. A batch that has been open
+    for max_wait seconds is emitted even if no new item arrives.
+
+    @param aiterable: async iterable
+    @param size: int
+    @param max_bytes: int
+    @param size_fn: func
+    @param max_wait: float, seconds
+    @return: AsyncGenerator(list)
+    """
+    builder = _BatchBuilder(size, max_bytes, size_fn, max_wait)
+    if max_wait is None and max_bytes is None:
+        cur_arr = []
+        async for item in aiterable:
+            cur_arr.append(item)
+            if len(cur_arr) >= size:
+                yield cur_arr
+                cur_arr = []
+        if cur_arr:
             yield cur_arr
-            cur_arr = []
-    if cur_arr:
-        yield cur_arr
-
-def flatten(x):
-    result = []
-    for el in x:
-        if hasattr(el, "__iter__") and not isinstance(el, basestring) and not isinstance(el, dict):
-            result.extend(flatten(el))
+        return
+    if max_wait is None:
+        async for item in aiterable:
+            for cur_arr in builder.add(item):
+                yield cur_arr
+        if builder.items:
+            yield builder.flush()
+        return
+    it = aiterable.__aiter__()
+    # Only while a batch is open, the next item is awaited as a task, so
+    # that the batch can be cut on time without cancelling the source.
+    pending = None
+    try:
+        while True:
+            if builder.items:
+                if pending is None:
+                    pending = asyncio.ensure_future(it.__anext__())
+                timeout = builder.started + max_wait - time.monotonic()
+                done, _ = await asyncio.wait([pending], timeout=max(timeout, 0))
+                if not done:
+                    yield builder.flush()
+                    continue
+            try:
+                if pending is None:
+                    item = await it.__anext__()
+                else:
+                    item = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                if pending is not None and pending.done():
+                    pending = None
+            for cur_arr in builder.add(item):
+                yield cur_arr
+    finally:
+        if pending is not None:
+            pending.cancel()
+    if builder.items:
+        yield builder.flush()
+
+def _map_batch(fn, items):
+    # Module level, so that it can be pickled for process pools.
+    return [fn(item) for item in items]
+
+def parallel_map(fn, iterable, batch_size=100, workers=None,
+        executor='thread', ordered=True, max_pending=None):
+    """
+    Apply fn to every item of iterable in a pool of workers, sending the
+    items over in batches. iterable is consumed lazily: at most max_pending
+    batches are in flight, so progress can be reported by wrapping it, e.g.
+    parallel_map(fn, adv_enumerate(items, total=len(items)), 100, 4).
+
+    If fn raises, the batches that have not started are cancelled and the
+    exception is raised to the caller.
+
+    @param fn: func, for process pools it has to be picklable
+    @param iterable: iterable
+    @param batch_size: int, number of items sent to a worker at once
+    @param workers: int, number of workers, defaults to the executor's own
+    @param executor: str|Executor, 'thread', 'process', or an existing
+    executor, which is left running afterwards
+    @param ordered: bool, yield results in the order of iterable if True,
+    and as batches complete otherwise
+    @param max_pending: int, max number of batches in flight, defaults to
+    twice the number of workers
+    @return: Generator
+    """
+    owned = not isinstance(executor, Executor)
+    if not owned:
+        pool = executor
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(workers)
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(workers)
+    else:
+        raise ValueError('unknown executor: %s' % executor)
+    max_pending = max_pending or 2 * (workers or os.cpu_count() or 1)
+    pending = deque() if ordered else set()
+
+    def _results():
+        if ordered:
+            return pending.popleft().result()
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        results = []
+        for future in done:
+            pending.remove(future)
+            results.extend(future.result())
+        return results
+
+    try:
+        for items in batch(iterable, batch_size):
+            if len(pending) >= max_pending:
+                for result in _results():
+                    yield result
+            future = pool.submit(_map_batch, fn, items)
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+        while pending:
+            for result in _results():
+                yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        if owned:
+            pool.shutdown(wait=True)
+
+def iflatten(x, max_depth=None, atomic_types=(str, bytes, dict)):
+    """
+    Lazily yield the leaves of arbitrarily nested iterables. Uses an explicit
+    stack of iterators, so deep nesting does not hit the recursion limit.
+    @param x: iterable
+    @param max_depth: int, only expand elements nested at most this deep;
+        elements of x are at depth 1, None expands everything
+    @param atomic_types: tuple, iterable types yielded as leaves. Strings
+        and bytes are always leaves, since a one char string iterates to
+        itself
+    """
+    # Whether a class is expanded, decided once per class rather than once
+    # per element; lists and tuples are seeded as the common case.
+    expandable = {t: not issubclass(t, atomic_types) for t in (list, tuple)}
+    stack = [iter(x)]
+    while stack:
+        expand = max_depth is None or len(stack) <= max_depth
+        for el in stack[-1]:
+            if expand:
+                cls = el.__class__
+                is_iterable = expandable.get(cls)
+                if is_iterable is None:
+                    is_iterable = expandable[cls] = (hasattr(cls, '__iter__')
+                        and not issubclass(cls, atomic_types)
+                        and not issubclass(cls, (str, bytes)))
+                if is_iterable:
+                    stack.append(iter(el))
+                    break
+            yield el
         else:
-            result.append(el)
-    return result
+            stack.pop()
+
+def flatten(x, max_depth=None, atomic_types=(str, bytes, dict)):
+    """
+    @param x: iterable
+    @return: list, see iflatten
+    """
+    return list(iflatten(x, max_depth=max_depth, atomic_types=atomic_types))
 
 def _display_msg(msg, use_print=False):
     """
@@ -107,6 +544,112 @@ def _display_msg(msg, use_print=False):
         return
     logging.info(msg)
 
+def _format_seconds(seconds):
+    return 'NA' if seconds is None else '%.1fs' % seconds
+
+class Progress(object):
+    """
+    Counters of a long running loop, with items/sec, elapsed time and ETA.
+    Used by adv_enumerate, and can be read directly to scrape progress:
+
+        progress = Progress(total=len(items))
+        for item in adv_enumerate(items, progress=progress):
+            ...
+        progress.as_dict() => {'count': ..., 'rate': ..., 'eta': ...}
+    """
+
+    def __init__(self, total=None, start=0, frequency=100, interval=None,
+            msg=None, use_print=False):
+        """
+        @param total: int, expected count, optional
+        @param start: int, initial count
+        @param frequency: int, report every frequency counts
+        @param interval: float, seconds. If given, report at most once every
+        interval seconds instead of by frequency.
+        @param msg: str, addition information
+        @param use_print: bool
+        """
+        self.total = total
+        self.start = start
+        self.count = start
+        self.frequency = frequency
+        self.interval = interval
+        self.msg = msg
+        self.use_print = use_print
+        self.started_at = time.monotonic()
+        self.reported_at = None
+
+    @property
+    def elapsed(self):
+        """
+        @return: float, seconds
+        """
+        return time.monotonic() - self.started_at
+
+    @property
+    def rate(self):
+        """
+        @return: float|None, counts per second
+        """
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return None
+        return (self.count - self.start) / elapsed
+
+    @property
+    def eta(self):
+        """
+        @return: float|None, estimated seconds left
+        """
+        rate = self.rate
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.count, 0) / rate
+
+    def _due(self):
+        if self.interval is None:
+            return not self.count % self.frequency
+        return (self.reported_at is None or
+                time.monotonic() - self.reported_at >= self.interval)
+
+    def update(self, count, report=True):
+        """
+        @param count: int, current count
+        @param report: bool, report if one is due
+        """
+        self.count = count
+        if report and self._due():
+            self.report()
+
+    def report(self):
+        _display_msg(str(self), self.use_print)
+        self.reported_at = time.monotonic()
+
+    def as_dict(self):
+        """
+        @return: dict
+        """
+        return {
+            'count': self.count,
+            'total': self.total,
+            'elapsed': self.elapsed,
+            'rate': self.rate,
+            'eta': self.eta,
+            }
+
+    def __str__(self):
+        rate = self.rate
+        to_print = "completed %s/%s, %s/s, elapsed %s, eta %s" % (
+                self.count,
+                'NA' if self.total is None else self.total,
+                'NA' if rate is None else '%.1f' % rate,
+                _format_seconds(self.elapsed),
+                _format_seconds(self.eta),
+                )
+        if self.msg:
+            to_print = "%s, %s" % (to_print, self.msg)
+        return to_print
+
 def adv_enumerate(list_,
         start=0,
         end=None,
@@ -114,83 +657,317 @@ def adv_enumerate(list_,
         use_print=False,
         get_tuple=False,
         msg=None,
+        interval=None,
+        total=None,
+        progress=None,
         ):
     """
     @param list_: list
     @param frequency: int
     @param use_print: bool
     @param msg: str, addition information
+    @param interval: float, seconds. If given, report at most once every
+    interval seconds instead of every frequency items.
+    @param total: int, number of items, if known. Otherwise it is probed
+    with get_iterable_len.
+    @param progress: Progress, optional. Tracks the loop instead of a new
+    one, in which case frequency, use_print, msg, interval and total are
+    taken from it.
     @return: Generator
     """
-    len_ = 'NA'
-    try:
-        len_ = len(list_)
-    except TypeError:
-        try:
-            len_ = list_.count()
-        except Exception:
-            pass
+    if progress is None:
+        if total is None:
+            total = get_iterable_len(list_, estimate=True)
+        progress = Progress(total, start=start, frequency=frequency,
+                interval=interval, msg=msg, use_print=use_print)
+    i = None
     for i, item in enumerate(list_, start=start):
-        if not i % frequency:
-            to_print = "completed %s/%s" % (i, len_)
-            if msg:
-                to_print = "%s, %s" % (to_print, msg)
-            _display_msg(to_print)
+        progress.update(i)
         if end and i >= end:
-            raise StopIteration
+            return
         yield (i, item) if get_tuple else item
+    if i is not None:
+        progress.update(i + 1, report=False)
 
-## {{{ http://code.activestate.com/recipes/576694/ (r9)
-import collections
+# Marks the position of a discarded key in an indexed OrderedSet
+_TOMBSTONE = object()
 
-class OrderedSet(collections.MutableSet):
+class OrderedSet(collections.abc.MutableSet):
+    """
+    Set that remembers insertion order, backed by an insertion ordered dict.
+
+    With indexed=True it also keeps a list of the keys for positional access
+    (s[i], s.index(key)), which is O(1) until keys are discarded. Discarded
+    keys leave tombstones in that list, and positions are then resolved in
+    O(log n) with a Fenwick tree counting the live slots. The list is
+    compacted once tombstones make up half of it.
+    """
+    __slots__ = ('_map', '_items', '_tombstones', '_tree')
 
-    def __init__(self, iterable=None):
-        self.end = end = []
-        end += [None, end, end]         # sentinel node for doubly linked list
-        self.map = {}                   # key --> [key, prev, next]
+    def __init__(self, iterable=None, indexed=False):
+        """
+        @param iterable: iterable, optional
+        @param indexed: bool, keep positions for O(1) indexing
+        """
+        # key --> None, or key --> position in _items if indexed
+        self._map = {}
+        self._items = [] if indexed else None
+        self._tombstones = 0
+        # Fenwick tree over the live slots of _items, 1-based. Only built
+        # when positions are read while there are tombstones.
+        self._tree = None
         if iterable is not None:
-            self |= iterable
+            self.update(iterable)
+
+    def _new(self, keys):
+        return self.__class__(keys, indexed=self._items is not None)
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return cls(iterable)
+
+    def __reduce__(self):
+        return (self.__class__, (list(self._map), self._items is not None))
 
     def __len__(self):
-        return len(self.map)
+        return len(self._map)
 
     def __contains__(self, key):
-        return key in self.map
+        return key in self._map
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def __reversed__(self):
+        try:
+            return reversed(self._map)
+        except TypeError:
+            # dicts are only reversible from Python 3.8 on.
+            return reversed(list(self._map))
+
+    def _compact(self):
+        self._items = list(self._map)
+        self._map = dict(zip(self._items, count()))
+        self._tombstones = 0
+        self._tree = None
+
+    def _build_tree(self):
+        size = len(self._items)
+        tree = [0] * (size + 1)
+        for i, key in enumerate(self._items, 1):
+            if key is not _TOMBSTONE:
+                tree[i] += 1
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _live_before(self, position):
+        """
+        @return: int, number of live slots before position
+        """
+        tree = self._tree
+        total = 0
+        while position:
+            total += tree[position]
+            position -= position & -position
+        return total
+
+    def _tree_append(self, live):
+        # The new node covers the slots (i - lowbit(i), i]
+        i = len(self._tree)
+        self._tree.append(live + self._live_before(i - 1)
+                          - self._live_before(i - (i & -i)))
+
+    def _tree_remove(self, position):
+        tree = self._tree
+        i = position + 1
+        while i < len(tree):
+            tree[i] -= 1
+            i += i & -i
+
+    def _position(self, index):
+        """
+        @param index: int, logical position, 0 <= index < len(self)
+        @return: int, slot of the index-th live key in _items
+        """
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        position = 0
+        remaining = index + 1
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            nxt = position + step
+            if nxt < len(tree) and tree[nxt] < remaining:
+                position = nxt
+                remaining -= tree[nxt]
+            step >>= 1
+        return position
 
     def add(self, key):
-        if key not in self.map:
-            end = self.end
-            curr = end[1]
-            curr[2] = end[1] = self.map[key] = [key, curr, end]
+        if key in self._map:
+            return
+        if self._items is None:
+            self._map[key] = None
+        else:
+            self._map[key] = len(self._items)
+            self._items.append(key)
+            if self._tree is not None:
+                self._tree_append(1)
 
-    def discard(self, key):
-        if key in self.map:
-            key, prev, next = self.map.pop(key)
-            prev[2] = next
-            next[1] = prev
+    def update(self, *iterables):
+        """
+        Add the keys of all the iterables, in order.
+        """
+        for iterable in iterables:
+            if self._items is None:
+                # Existing keys keep their position.
+                self._map.update(dict.fromkeys(iterable))
+                continue
+            fresh = list(filterfalse(self._map.__contains__,
+                dict.fromkeys(iterable)))
+            self._map.update(zip(fresh, count(len(self._items))))
+            self._items.extend(fresh)
+            if self._tree is not None:
+                for _ in fresh:
+                    self._tree_append(1)
 
-    def __iter__(self):
-        end = self.end
-        curr = end[2]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[2]
+    def discard(self, key):
+        if self._items is None:
+            self._map.pop(key, None)
+            return
+        position = self._map.pop(key, None)
+        if position is None:
+            return
+        self._items[position] = _TOMBSTONE
+        self._tombstones += 1
+        if self._tombstones > len(self._items) // 2:
+            self._compact()
+        elif self._tree is not None:
+            self._tree_remove(position)
 
-    def __reversed__(self):
-        end = self.end
-        curr = end[1]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[1]
+    def clear(self):
+        self._map.clear()
+        if self._items is not None:
+            self._items = []
+        self._tombstones = 0
+        self._tree = None
 
     def pop(self, last=True):
         if not self:
             raise KeyError('set is empty')
-        key = self.end[1][0] if last else self.end[2][0]
+        key = next(reversed(self)) if last else next(iter(self._map))
         self.discard(key)
         return key
 
+    def __getitem__(self, index):
+        """
+        @param index: int|slice
+        @return: Object, or a list for slices
+        """
+        if self._items is None:
+            if isinstance(index, slice) or index < 0:
+                return list(self._map)[index]
+            try:
+                return next(islice(self._map, index, None))
+            except StopIteration:
+                raise IndexError('index out of range')
+        if not self._tombstones:
+            return self._items[index]
+        size = len(self._map)
+        if isinstance(index, slice):
+            return [self._items[self._position(i)]
+                    for i in range(*index.indices(size))]
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('index out of range')
+        return self._items[self._position(index)]
+
+    def index(self, key):
+        """
+        @return: int, position of key
+        """
+        if key not in self._map:
+            raise ValueError('%r is not in set' % (key,))
+        if self._items is None:
+            for position, cur in enumerate(self._map):
+                if cur == key:
+                    return position
+        if not self._tombstones:
+            return self._map[key]
+        if self._tree is None:
+            self._build_tree()
+        return self._live_before(self._map[key])
+
+    def copy(self):
+        return self._new(self._map)
+
+    def _as_set(self, other):
+        """
+        @return: collection with a fast __contains__
+        """
+        if isinstance(other, (collections.abc.Set, dict)):
+            return other
+        return set(other)
+
+    # Set algebra keeps the order of self, followed by the order of other.
+    def __or__(self, other):
+        if not isinstance(other, collections.abc.Iterable):
+            return NotImplemented
+        result = self.copy()
+        result.update(other)
+        return result
+
+    def __and__(self, other):
+        if not isinstance(other, collections.abc.Iterable):
+            return NotImplemented
+        return self._new(filter(self._as_set(other).__contains__, self._map))
+
+    def __sub__(self, other):
+        if not isinstance(other, collections.abc.Iterable):
+            return NotImplemented
+        return self._new(filterfalse(self._as_set(other).__contains__,
+            self._map))
+
+    def __xor__(self, other):
+        if not isinstance(other, collections.abc.Iterable):
+            return NotImplemented
+        other = self._new(other)
+        result = self - other
+        result.update(other - self)
+        return result
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        if other is self:
+            self.clear()
+        else:
+            for key in other:
+                self.discard(key)
+        return self
+
+    def union(self, *others):
+        result = self.copy()
+        result.update(*others)
+        return result
+
+    def intersection(self, *others):
+        result = self
+        for other in others:
+            result = result & other
+        return result if others else self.copy()
+
+    def difference(self, *others):
+        result = self
+        for other in others:
+            result = result - other
+        return result if others else self.copy()
+
     def __repr__(self):
         if not self:
             return '%s()' % (self.__class__.__name__,)
@@ -201,55 +978,480 @@ class OrderedSet(collections.MutableSet):
             return len(self) == len(other) and list(self) == list(other)
         return set(self) == set(other)
 
-def split(l, split_fn):
+    __hash__ = None
+
+def split(l, split_fn, with_keys=False):
     """
     Take a list, and break it into list of lists based on the has value
     that is return by split_fn.
 
     @param l: list
     @param split_fn: func
+    @param with_keys: bool, return (key, items) pairs instead of the groups
     @return: list(list)
     """
     data = defaultdict(list)
     for item in l:
         data[split_fn(item)].append(item)
-    return data.values()
+    if with_keys:
+        return list(data.items())
+    return list(data.values())
 
+def _sink_writer(sink):
+    """
+    @return: func, writing a list of items to a list, file or callback sink
+    """
+    if hasattr(sink, 'extend'):
+        return sink.extend
+    if hasattr(sink, 'writelines'):
+        return sink.writelines
+    if callable(sink):
+        return sink
+    raise TypeError('sink %r has no extend or writelines and is not callable'
+                    % (sink,))
+
+def partition_stream(iterable, key_fn, sink_factory=None, max_buffer=1000):
+    """
+    Route items into a sink per key in a single pass. Items are buffered per
+    key and handed to the sink whenever max_buffer of them are pending, so
+    only max_buffer items per key are held in memory.
+
+    @param iterable: iterable
+    @param key_fn: func, item -> key
+    @param sink_factory: func, key -> sink, called the first time a key is
+        seen. A sink is a list (extended), a file (writelines) or a callable
+        taking a list of items; defaults to an in memory list
+    @param max_buffer: int, items buffered per key before a flush, None
+        buffers everything until the end
+    @return: dict, key -> sink in order of first appearance
+    """
+    sinks = {}
+    writers = {}
+    buffers = {}
+    for item in iterable:
+        key = key_fn(item)
+        buffer = buffers.get(key)
+        if buffer is None:
+            sink = sink_factory(key) if sink_factory else []
+            sinks[key] = sink
+            writers[key] = _sink_writer(sink)
+            buffer = buffers[key] = []
+        buffer.append(item)
+        if max_buffer and len(buffer) >= max_buffer:
+            writers[key](buffer)
+            buffers[key] = []
+    for key, buffer in buffers.items():
+        if buffer:
+            writers[key](buffer)
+    return sinks
 
 def roundrobin(*iterables):
-    "roundrobin('ABC', 'D', 'EF') --> A D E B F C"
-    # Recipe credited to George Sakkis
-    pending = len(iterables)
-    nexts = cycle(iter(it).next for it in iterables)
-    while pending:
+    """
+    roundrobin('ABC', 'D', 'EF') --> A D E B F C
+    Exhausted iterables are dropped from the rotation in O(1).
+    """
+    nexts = deque(iter(it).__next__ for it in iterables)
+    while nexts:
+        try:
+            while True:
+                yield nexts[0]()
+                nexts.rotate(-1)
+        except StopIteration:
+            nexts.popleft()
+
+def weighted_roundrobin(iterables, weights):
+    """
+    Like roundrobin, but on its turn each iterable yields up to its weight in
+    consecutive items.
+    weighted_roundrobin(['ABC', 'DEF'], [2, 1]) --> A B D C E F
+
+    @param iterables: list(iterable)
+    @param weights: list(int), positive
+    @return: generator
+    """
+    if len(iterables) != len(weights):
+        raise ValueError('got %s iterables and %s weights' % (len(iterables),
+                                                              len(weights)))
+    if any(weight < 1 for weight in weights):
+        raise ValueError('weights must be positive integers')
+    turns = deque((iter(it).__next__, int(weight))
+                  for it, weight in zip(iterables, weights))
+    while turns:
+        next_, weight = turns[0]
         try:
-            for next in nexts:
-                yield next()
+            for _ in range(weight):
+                yield next_()
         except StopIteration:
-            pending -= 1
-            nexts = cycle(islice(nexts, pending))
+            turns.popleft()
+        else:
+            turns.rotate(-1)
+
+async def async_roundrobin(*aiterables):
+    """
+    Interleave async iterables as they produce items: a slow iterable does
+    not hold back the others. Items that become ready together are yielded in
+    the order the iterables were given.
+
+    @param aiterables: async iterables
+    @return: AsyncGenerator
+    """
+    iterators = [it.__aiter__() for it in aiterables]
+    pending = {}
+    for idx, it in enumerate(iterators):
+        pending[asyncio.ensure_future(it.__anext__())] = idx
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=pending.get):
+                idx = pending.pop(task)
+                try:
+                    item = task.result()
+                except StopAsyncIteration:
+                    continue
+                pending[asyncio.ensure_future(iterators[idx].__anext__())] = idx
+                yield item
+    finally:
+        for task in pending:
+            task.cancel()
+
+# Modes of dedup_iter
+DEDUP_EXACT = 'exact'
+DEDUP_WINDOW = 'window'
+DEDUP_BLOOM = 'bloom'
+
+_MASK_64 = (1 << 64) - 1
+
+def _mix64(h):
+    """
+    Spread the bits of a hash, since hash(int) is the int itself.
+    """
+    h &= _MASK_64
+    h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & _MASK_64
+    h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & _MASK_64
+    return h ^ (h >> 31)
+
+def _stable_key_bytes(key):
+    """
+    Encode key to bytes that are the same in every process. Keys that are
+    equal as set members (1, 1.0 and True) encode the same.
+
+    @return: bytes, or None for types without a stable encoding
+    """
+    if isinstance(key, str):
+        return b's' + key.encode('utf-8', 'surrogatepass')
+    if isinstance(key, bytes):
+        return b'b' + key
+    if isinstance(key, float):
+        if key.is_integer():
+            return b'i%d' % int(key)
+        return b'f' + repr(key).encode('ascii')
+    if isinstance(key, int):
+        return b'i%d' % key
+    if key is None:
+        return b'n'
+    if isinstance(key, tuple):
+        parts = [b't']
+        for item in key:
+            encoded = _stable_key_bytes(item)
+            if encoded is None:
+                return None
+            parts.append(b'%d:' % len(encoded))
+            parts.append(encoded)
+        return b''.join(parts)
+    return None
+
+class BloomFilter(object):
+    """
+    Probabilistic set of hashable keys backed by a bit array. Membership
+    tests have no false negatives, and false positives at roughly error_rate
+    as long as no more than capacity keys are added.
+
+    str, bytes, numbers, None and tuples of those are hashed with blake2b
+    over a stable encoding, so their bits are the same in every process and
+    a filter can be shared by the processes of a split or resumed job.
+    Other keys fall back to hash(), which is only valid within a process.
+    """
+    __slots__ = ('capacity', 'error_rate', 'size', 'hashes', 'bits')
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        @param capacity: int, expected number of keys
+        @param error_rate: float, false positive rate at capacity
+        """
+        assert(capacity > 0 and 0 < error_rate < 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        encoded = _stable_key_bytes(key)
+        if encoded is None:
+            h = _mix64(hash(key))
+            h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        else:
+            digest = hashlib.blake2b(encoded, digest_size=16).digest()
+            h1 = int.from_bytes(digest[:8], 'little')
+            h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        """
+        @param key: Object
+        @return: bool, whether key was (probably) already in the filter
+        """
+        bits = self.bits
+        present = True
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                present = False
+        return present
+
+class _RecentKeys(object):
+    """
+    Set of the window most recently seen keys.
+    """
+    __slots__ = ('window', 'keys')
+
+    def __init__(self, window):
+        assert(window > 0)
+        self.window = window
+        self.keys = OrderedDict()
+
+    def add(self, key):
+        """
+        @return: bool, whether key was already among the recent keys
+        """
+        keys = self.keys
+        if key in keys:
+            keys.move_to_end(key)
+            return True
+        keys[key] = None
+        if len(keys) > self.window:
+            keys.popitem(last=False)
+        return False
 
 def dedup(l, fn=None):
-    seen = set()
-    to_return = []
+    return list(dedup_iter(l, fn))
+
+def dedup_iter(l, fn=None, mode=DEDUP_EXACT, window=None, capacity=None,
+        error_rate=0.001, stats=None):
+    """
+    Lazily drop the items of l whose key has been seen before.
+
+    @param l: iterable
+    @param fn: func, optional. Key of an item, defaults to the item itself.
+    @param mode: str, one of
+        DEDUP_EXACT: remember every key (the default)
+        DEDUP_WINDOW: only remember the window most recently seen keys, so
+        duplicates further apart than that are let through
+        DEDUP_BLOOM: remember keys in a BloomFilter of the given capacity and
+        error_rate, so unique items are dropped with a probability of about
+        error_rate. Keys are hashed the same way in every process if they
+        are str, bytes, numbers, None or tuples of those
+    @param window: int, required for DEDUP_WINDOW
+    @param capacity: int, required for DEDUP_BLOOM, expected number of keys
+    @param error_rate: float, for DEDUP_BLOOM
+    @param stats: dict, optional. Updated in place with the number of items
+    'seen' and 'dropped' so far.
+    @return: Generator
+    """
+    if mode == DEDUP_EXACT:
+        seen = set()
+        def seen_before(key):
+            if key in seen:
+                return True
+            seen.add(key)
+            return False
+    elif mode == DEDUP_WINDOW:
+        if not window:
+            raise ValueError('window is required for %s' % mode)
+        seen_before = _RecentKeys(window).add
+    elif mode == DEDUP_BLOOM:
+        if not capacity:
+            raise ValueError('capacity is required for %s' % mode)
+        seen_before = BloomFilter(capacity, error_rate).add
+    else:
+        raise ValueError('unknown mode: %s' % mode)
+    if stats is not None:
+        stats.setdefault('seen', 0)
+        stats.setdefault('dropped', 0)
     for i in l:
-        if fn:
-            if not fn(i) in seen:
-                to_return.append(i)
-                seen.add(fn(i))
-        else:
-            if not i in seen:
-                to_return.append(i)
-                seen.add(i)
-    return to_return
+        if stats is not None:
+            stats['seen'] += 1
+        if seen_before(fn(i) if fn else i):
+            if stats is not None:
+                stats['dropped'] += 1
+            continue
+        yield i
+
+# type -> (estimator, exact), see register_length_estimator
+_LENGTH_ESTIMATORS = {}
+# Results of .count(), so that a cursor is counted at most once
+_COUNT_CACHE = weakref.WeakKeyDictionary()
+
+def register_length_estimator(type_, fn, exact=False):
+    """
+    Register a cheap way of sizing instances of type_ (and its subclasses)
+    for get_iterable_len, e.g. a collection's estimated document count for
+    a cursor instead of a counting round trip.
 
-def get_iterable_len(i):
+    @param type_: type
+    @param fn: func, object -> int|None, None when it cannot tell
+    @param exact: bool, whether fn returns exact lengths. Inexact ones are
+        only used when an estimate is asked for
     """
+    _LENGTH_ESTIMATORS[type_] = (fn, exact)
+
+def _estimate_len(i, estimate):
+    for type_ in type(i).__mro__:
+        if type_ in _LENGTH_ESTIMATORS:
+            fn, exact = _LENGTH_ESTIMATORS[type_]
+            if exact or estimate:
+                return fn(i)
+            return None
+    return None
+
+def _cached_count(i):
+    try:
+        return _COUNT_CACHE[i]
+    except (KeyError, TypeError):
+        pass
+    length = i.count()
+    try:
+        _COUNT_CACHE[i] = length
+    except TypeError:
+        # Not weak referenceable, so it cannot be cached
+        pass
+    return length
+
+def get_iterable_len(i, estimate=False, default=None):
+    """
+    Length of an iterable, probed as cheaply as possible: len(), then a
+    registered estimator, then (when estimate is set) operator.length_hint,
+    and finally a .count() method, whose result is cached per object.
+
+    @param i: iterable
+    @param estimate: bool, accept an estimate instead of an exact length
+    @param default: returned when the length cannot be found
     @return: int
     """
-    if (isinstance(i, list)):
+    try:
         return len(i)
-    return i.count()
+    except TypeError:
+        pass
+    length = _estimate_len(i, estimate)
+    if length is not None:
+        return length
+    if estimate:
+        length = operator.length_hint(i, -1)
+        if length >= 0:
+            return length
+    count_fn = getattr(i, 'count', None)
+    if callable(count_fn):
+        try:
+            return _cached_count(i)
+        except TypeError:
+            # count() that takes arguments, e.g. itertools.count
+            pass
+    return default
+
+class MultiListView(Sequence):
+    """
+    Lazy version of to_multilist: a sequence of rows of cols items each,
+    sliced out of l only when they are accessed. Generic iterables are
+    buffered only as far as the rows that have been read.
+
+    >>> grid = MultiListView(results, cols=5, rows=20)
+    >>> first_page = grid[:4]
+    """
+
+    def __init__(self, l, cols, rows=None):
+        """
+        @param l: iterable
+        @param cols: int
+        @param rows: int, maximum number of rows
+        """
+        if not cols or cols < 1:
+            raise ValueError('cols must be a positive integer')
+        self.cols = cols
+        self.rows = rows
+        if isinstance(l, Sequence):
+            self._items = l
+            self._it = None
+        else:
+            self._items = []
+            self._it = iter(l)
+
+    def _fill(self, size):
+        # Buffer the source until it has size items or is exhausted.
+        if self._it is not None and len(self._items) < size:
+            self._items.extend(islice(self._it, size - len(self._items)))
+            if len(self._items) < size:
+                self._it = None
+
+    def _row(self, idx):
+        if self.rows is not None and idx >= self.rows:
+            return None
+        start = idx * self.cols
+        self._fill(start + self.cols)
+        row = self._items[start:start + self.cols]
+        return row if len(row) else None
+
+    def __len__(self):
+        limit = None if self.rows is None else self.rows * self.cols
+        if self._it is not None:
+            if limit is None:
+                self._items.extend(self._it)
+                self._it = None
+            else:
+                self._fill(limit)
+        size = len(self._items)
+        if limit is not None:
+            size = min(size, limit)
+        return (size + self.cols - 1) // self.cols
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.start, idx.stop, idx.step
+            if (step is None or step > 0) and (start is None or start >= 0) \
+                    and stop is not None and stop >= 0:
+                # Forward slices are read without computing the length.
+                rows = []
+                for row_idx in range(start or 0, stop, step or 1):
+                    row = self._row(row_idx)
+                    if row is None:
+                        break
+                    rows.append(row)
+                return rows
+            return [self._row(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        row = self._row(idx) if idx >= 0 else None
+        if row is None:
+            raise IndexError('row index out of range')
+        return row
+
+    def __iter__(self):
+        for idx in count():
+            row = self._row(idx)
+            if row is None:
+                return
+            yield row
+
+    def __repr__(self):
+        return '%s(cols=%r, rows=%r)' % (self.__class__.__name__, self.cols,
+                                        self.rows)
 
 def to_multilist(l, cols, rows=None):
     """
@@ -1,10 +1,17 @@
 # This Python file uses the following encoding: utf-8
+from collections import deque
+from functools import lru_cache
 import logging
 import posixpath
 import random
 import re
 import string
 
+# Number of compiled keyword sets kept around for string_contains
+MATCHER_CACHE_SIZE = 16
+# string_contains only compiles and caches keyword sets up to this size
+MATCHER_CACHE_MAX_KEYWORDS = 1000
+
 PHONE_NUMBER_PATTERN = re.compile(r'(\d{3})[-).(] *(\d{3})[-.](\d{4})')
 
 TURKISH_TO_LATIN_CHAR_MAP = {
@@ -20,6 +27,240 @@ TURKISH_TO_LATIN_CHAR_MAP = {
 def generate_str(size=32, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for x in range(size))
 
+class _Automaton(object):
+    """
+    Aho-Corasick automaton over a set of keywords: finds every occurrence of
+    every keyword in a single pass over the text.
+    """
+    __slots__ = ('goto', 'fail', 'out')
+
+    def __init__(self, keywords):
+        # goto[state] maps a char to the next state, out[state] holds the
+        # keywords that end at state, including those of its suffixes.
+        goto = [{}]
+        out = [()]
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto.append({})
+                    out.append(())
+                    goto[state][char] = next_state
+                state = next_state
+            out[state] = (keyword,)
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fallback = goto[fallback].get(char, 0)
+                fail[next_state] = fallback if fallback != next_state else 0
+                out[next_state] += out[fail[next_state]]
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+
+    def iter_matches(self, text):
+        """
+        @return: generator((int, str)), end index and keyword of every match
+        """
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for idx, char in enumerate(text):
+            while True:
+                next_state = goto[state].get(char)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            if out[state]:
+                for keyword in out[state]:
+                    yield idx, keyword
+
+def _trie_regex(keywords):
+    """
+    @return: str, a regex alternation of keywords shaped like their prefix
+    trie, so the regex engine never retries a shared prefix
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def to_regex(node):
+        branches = []
+        chars = []
+        for char in sorted(key for key in node if key):
+            child = node[char]
+            if len(child) == 1 and '' in child:
+                chars.append(re.escape(char))
+            else:
+                branches.append(re.escape(char) + to_regex(child))
+        # A lone char or char class needs no group, even when optional
+        atomic = not branches
+        if chars:
+            branches.append(chars[0] if len(chars) == 1
+                            else '[%s]' % ''.join(chars))
+        optional = '' in node
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        if atomic and optional:
+            return branches[0] + '?'
+        regex = '(?:%s)' % '|'.join(branches)
+        return regex + '?' if optional else regex
+
+    return to_regex(trie)
+
+# Engines of KeywordMatcher
+MATCH_SCAN = 'scan'
+MATCH_AUTOMATON = 'automaton'
+MATCH_REGEX = 'regex'
+
+# Default engines by number of keywords: a str.find per keyword for a
+# handful, a trie shaped regex up to a few thousand, where it is faster and
+# much smaller than the automaton, and the automaton above that.
+_SCAN_MAX_KEYWORDS = 16
+_REGEX_MAX_KEYWORDS = 5000
+
+class KeywordMatcher(object):
+    """
+    A set of keywords compiled once, so that checking a text against all of
+    them is a single pass over the text rather than a scan per keyword.
+
+    >>> matcher = KeywordMatcher(['apple', 'orange'])
+    >>> matcher.contains('Apple Pie')
+    True
+    >>> matcher.find_all('orange apple')
+    ['orange', 'apple']
+    """
+
+    def __init__(self, keywords, lower=True, full_word=False, engine=None):
+        """
+        @param keywords: iterable(str)
+        @param lower: bool, match case insensitively
+        @param full_word: bool, only match keywords that are whole words of
+        the text, i.e. items of text.split()
+        @param engine: str, MATCH_SCAN, MATCH_AUTOMATON or MATCH_REGEX for
+        substring matching. By default, a scan for a handful of keywords, a
+        regex for up to a few thousand and an Aho-Corasick automaton
+        otherwise. MATCH_REGEX compiles a trie shaped regex, which is only
+        used by contains, find_all builds an automaton on first use
+        """
+        if lower:
+            keywords = [keyword.lower() for keyword in keywords]
+        # Distinct keywords, in their original order
+        self.keywords = tuple(dict.fromkeys(keywords))
+        self.lower = lower
+        self.full_word = full_word
+        self._word_set = frozenset(self.keywords) if full_word else None
+        # '' is a substring of everything
+        self._matches_all = '' in self.keywords and not full_word
+        self._keywords = tuple(keyword for keyword in self.keywords if keyword)
+        if engine is None:
+            if len(self._keywords) <= _SCAN_MAX_KEYWORDS:
+                engine = MATCH_SCAN
+            elif len(self._keywords) <= _REGEX_MAX_KEYWORDS:
+                engine = MATCH_REGEX
+            else:
+                engine = MATCH_AUTOMATON
+        if engine not in (MATCH_SCAN, MATCH_AUTOMATON, MATCH_REGEX):
+            raise ValueError('unknown engine %r' % (engine,))
+        self.engine = engine
+        self._automaton = None
+        self._regex = None
+        if not full_word:
+            if engine == MATCH_AUTOMATON:
+                self._automaton = _Automaton(self._keywords)
+            elif engine == MATCH_REGEX and self._keywords:
+                self._regex = re.compile(_trie_regex(self._keywords))
+
+    def contains(self, text):
+        """
+        @param text: str
+        @return: bool, whether any keyword occurs in text
+        """
+        if not text:
+            return False
+        if self.lower:
+            text = text.lower()
+        if self.full_word:
+            return not self._word_set.isdisjoint(text.split())
+        if self._matches_all:
+            return True
+        if self.engine == MATCH_SCAN:
+            for keyword in self._keywords:
+                if keyword in text:
+                    return True
+            return False
+        if self.engine == MATCH_REGEX:
+            return self._regex is not None and self._regex.search(text) is not None
+        for _ in self._automaton.iter_matches(text):
+            return True
+        return False
+
+    def find_all(self, text):
+        """
+        @param text: str
+        @return: list(str), the distinct keywords that occur in text, in the
+        order of their first occurrence (longer first for the same start)
+        """
+        if not text:
+            return []
+        if self.lower:
+            text = text.lower()
+        if self.full_word:
+            word_set = self._word_set
+            return list(dict.fromkeys(
+                word for word in text.split() if word in word_set))
+        if self.engine == MATCH_SCAN:
+            starts = {}
+            for keyword in self._keywords:
+                start = text.find(keyword)
+                if start >= 0:
+                    starts[keyword] = start
+        else:
+            if self._automaton is None:
+                # The regex engine only answers contains
+                self._automaton = _Automaton(self._keywords)
+            starts = {}
+            for end, keyword in self._automaton.iter_matches(text):
+                if keyword not in starts:
+                    starts[keyword] = end - len(keyword) + 1
+        return sorted(starts, key=lambda keyword: (starts[keyword],
+                                                   -len(keyword)))
+
+    def contains_many(self, texts):
+        """
+        @param texts: iterable(str)
+        @return: list(bool)
+        """
+        contains = self.contains
+        return [contains(text) for text in texts]
+
+    def find_all_many(self, texts):
+        """
+        @param texts: iterable(str)
+        @return: list(list(str))
+        """
+        find_all = self.find_all
+        return [find_all(text) for text in texts]
+
+@lru_cache(maxsize=MATCHER_CACHE_SIZE)
+def _get_keyword_matcher(keywords, lower, full_word):
+    return KeywordMatcher(keywords, lower=lower, full_word=full_word)
+
 def string_contains(string, keywords, lower=True, full_word=False):
     """
     @param word: str
@@ -28,19 +269,21 @@ def string_contains(string, keywords, lower=True, full_word=False):
     @param full_word: bool, only return true if string contains a full_word
     that matches one of the keywords
     @return: bool
+
+    Up to MATCHER_CACHE_MAX_KEYWORDS keywords are compiled into a
+    KeywordMatcher, which is cached, so repeated calls with the same keywords
+    do not rebuild it. Larger lists are scanned keyword by keyword on every
+    call, build a KeywordMatcher once to check many strings against them.
     """
     if not string:
         return False
-    if lower:
-        string = string.lower()
-        words = [w.lower() for w in keywords]
-    if not full_word:
-        return bool([w for w in words if w in string])
-    for keyword in keywords:
-        for word in string.split():
-            if word == keyword:
-                return True
-    return False
+    keywords = tuple(keywords)
+    if len(keywords) > MATCHER_CACHE_MAX_KEYWORDS:
+        matcher = KeywordMatcher(keywords, lower=lower, full_word=full_word,
+                                 engine=MATCH_SCAN)
+    else:
+        matcher = _get_keyword_matcher(keywords, lower, full_word)
+    return matcher.contains(string)
 
 def _callback(matches):
     id = matches.group(1)
@@ -165,6 +408,14 @@ def _suffix(d):
 def custom_strftime(format, t):
     return t.strftime(format).replace('{S}', str(t.day) + _suffix(t.day))
 
+# slugify keeps [a-zA-Z0-9 ] and lowers A-Z. Everything else is dropped,
+# non ascii chars while encoding and the rest by bytes.translate.
+_SLUG_TABLE = bytes.maketrans(string.ascii_uppercase.encode('ascii'),
+                              string.ascii_lowercase.encode('ascii'))
+_SLUG_DELETE = bytes(code for code in range(128)
+                     if chr(code) not in string.ascii_letters + string.digits + ' ')
+_SPACES = re.compile(' +')
+
 def slugify(n):
     """
     TODO: Normally do not use this, and use django's version. We are using
@@ -173,6 +424,8 @@ def slugify(n):
     @param n: str
     @return: str
     """
-    n = re.sub(r'[^a-zA-Z0-9 ]', '', n)
-    n = re.sub(r'\s+', '-', n).lower()
-    return n
+    n = n.encode('ascii', 'ignore').translate(_SLUG_TABLE, _SLUG_DELETE)
+    n = n.decode('ascii')
+    if '  ' in n:
+        return _SPACES.sub('-', n)
+    return n.replace(' ', '-')
@@ -1,8 +1,31 @@
 from datetime import datetime
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from utensils.dictutils import apply_to_dict
+from utensils.dictutils import APPLY_COPY_ON_WRITE
+from utensils.dictutils import APPLY_IN_PLACE
+from utensils.dictutils import combine_dicts
+from utensils.dictutils import combine_dicts_iter
+from utensils.dictutils import compile_path
+from utensils.dictutils import compile_transform
+from utensils.dictutils import deep_items
+from utensils.dictutils import extract_columns
+from utensils.dictutils import flatten
 from utensils.dictutils import get_dotted
 from utensils.dictutils import get_value_for_key
+from utensils.dictutils import group_by_key
+from utensils.dictutils import iter_deep_items
+from utensils.dictutils import iter_flatten
+from utensils.dictutils import KeyIndex
+from utensils.dictutils import order
+from utensils.dictutils import to_dict_by_key
+from utensils.dictutils import transform
+from utensils.dictutils import transform_many
 
 
 class TestDictutils(unittest.TestCase):
@@ -67,6 +90,198 @@ class TestDictutils(unittest.TestCase):
                 }
         self.assertEquals(2, get_dotted(dict_, 'foo[@bla=4@foo=3].bar'))
 
+    def test_compile_path(self):
+        dict_ = {
+                'foo': [
+                    {'bar': 1, 'bla': 3, 'baz': {'x': 'a'}},
+                    {'bar': 2, 'bla': 4, 'baz': {'x': 'b'}},
+                    ],
+                }
+        path = compile_path('foo[@bla=4].bar')
+        self.assertEqual(2, path.get(dict_))
+        self.assertEqual(None, path.get({'foo': [{'bla': 3}]}))
+        self.assertEqual(['a', 'b'], compile_path('foo[*].baz.x').get(dict_))
+        self.assertEqual('a', compile_path('foo[0]/baz/x', '/').get(dict_))
+        self.assertEqual(5, compile_path('foo[1].nope').get(dict_, default=5))
+        self.assertTrue(compile_path('foo.bar') is compile_path('foo.bar'))
+
+    def test_compile_path_bad_accessor(self):
+        # Malformed accessors only raise once a lookup reaches them.
+        self.assertEqual(None, get_dotted({}, 'a.b[x]'))
+        self.assertEqual(None, get_dotted({'a': 1}, 'a.b[@x]'))
+        self.assertEqual(None, extract_columns([{}], ['a.b[x]'])['a.b[x]'][0])
+        self.assertRaises(ValueError, get_dotted, {'a': {'b': [1]}}, 'a.b[x]')
+        self.assertRaises(IndexError, get_dotted, {'a': {'b': {}}}, 'a.b[@x]')
+        self.assertRaises(ValueError, extract_columns, [{'a': [1]}], ['a[x]'])
+        self.assertEqual(2, get_dotted({'a': [{'*': 1, 'b': 2}]}, 'a[@*=1].b'))
+
+    def test_compile_transform(self):
+        dicts = [
+                {'a': {'b': i, 'c': [{'d': i * 2}]}, 'e': 'f%s' % i}
+                for i in range(3)
+                ]
+        mapper = {'a.b': 'x.y', 'a.c[0].d': 'x.z', 'e': 'w', 'missing': 'x.m'}
+        plan = compile_transform(mapper)
+        self.assertEqual([transform(d, mapper) for d in dicts],
+                list(transform_many(dicts, plan)))
+        self.assertEqual({'x': {'y': 0, 'z': 0, 'm': None}, 'w': 'f0'},
+                plan.apply(dicts[0]))
+
+        plan = compile_transform({'a.b': 'a.g', 'e': 'e'}, clone=True)
+        self.assertEqual(transform(dicts[1], plan.mapper, clone=True),
+                plan.apply(dicts[1]))
+
+        # Conflicting targets are applied in order, like transform.
+        mapper = {'e': 'x.y', 'a': 'x'}
+        self.assertEqual(transform(dicts[2], mapper),
+                list(transform_many(dicts[2:], mapper))[0])
+
+    def test_extract_columns(self):
+        records = [
+                {'a': {'b': 1, 'c': {'d': 2}}, 'e': [{'id': 1, 'v': 'x'}]},
+                {'a': {'b': 3}, 'e': [{'id': 2, 'v': 'y'}, {'id': 1, 'v': 'z'}]},
+                'not a dict',
+                ]
+        fields = ['a.b', 'a.c.d', 'e[@id=1].v', 'e[*].id']
+        columns = extract_columns(records, fields, default=0)
+        self.assertEqual(fields, list(columns))
+        for field in fields:
+            self.assertEqual([get_dotted(r, field, 0) for r in records],
+                    columns[field])
+        self.assertEqual([1, 3, 0], list(
+            extract_columns(records, ['a.b'], default=0, dtype='l')['a.b']))
+        self.assertEqual([1, -1], list(extract_columns([{'a': 1}, {}], ['a'],
+            default=-1, dtype='l')['a']))
+        self.assertRaises(ValueError, extract_columns, [{'a': 1}, {}], ['a'],
+                dtype='l')
+
+    def test_iter_deep_items(self):
+        dict_ = {'a': {'b': 1, 'c': [2, {'d': 3}]}, 'e': 4}
+        self.assertEqual([('a.b', 1), ('a.c', [2, {'d': 3}]), ('e', 4)],
+                deep_items(dict_))
+        self.assertEqual(deep_items(dict_), list(iter_deep_items(dict_)))
+        self.assertEqual([('a.b', 1), ('a.c[0]', 2), ('a.c[1].d', 3), ('e', 4)],
+                list(iter_deep_items(dict_, lists=True)))
+        self.assertEqual([(('a', 'b'), 1), (('a', 'c', 0), 2),
+            (('a', 'c', 1, 'd'), 3), (('e',), 4)],
+            list(iter_deep_items(dict_, tuple_paths=True, lists=True)))
+
+        # Deeper than the recursion limit
+        deep = cur = {}
+        for _ in range(5000):
+            cur['k'] = cur = {}
+        cur['v'] = 1
+        self.assertEqual(1, next(iter_deep_items(deep, tuple_paths=True))[1])
+
+    def test_apply_to_dict(self):
+        dict_ = {'a': [1, 'x', {'b': 2}], 'c': {'d': 'y'}, 'e': 3}
+        double = lambda v: v * 2 if isinstance(v, int) else v
+        expected = {'a': [2, 'x', {'b': 4}], 'c': {'d': 'y'}, 'e': 6}
+
+        copied = apply_to_dict(dict_, double)
+        self.assertEqual(expected, copied)
+        self.assertFalse(copied['c'] is dict_['c'])
+
+        # Only the containers holding changed leaves are copied.
+        shared = apply_to_dict(dict_, double, mode=APPLY_COPY_ON_WRITE)
+        self.assertEqual(expected, shared)
+        self.assertTrue(shared['c'] is dict_['c'])
+        self.assertFalse(shared['a'] is dict_['a'])
+        self.assertTrue(dict_ is apply_to_dict(dict_, lambda v: v,
+            mode=APPLY_COPY_ON_WRITE))
+
+        self.assertEqual({'A': [1, 'x', {'B': 2}], 'C': {'D': 'y'}, 'E': 3},
+                apply_to_dict(dict_, lambda v: v, key_function=str.upper))
+
+        nested = dict_['a']
+        self.assertTrue(dict_ is apply_to_dict(dict_, double,
+            mode=APPLY_IN_PLACE))
+        self.assertEqual(expected, dict_)
+        self.assertTrue(nested is dict_['a'])
+
+    def test_combine_dicts_iter(self):
+        dicts = [{'a': 1, 'b': 2, 'c': 3}, {'a': 4, 'c': 1}, {'c': 2, 'a': 0}]
+        self.assertEqual({'a': 5, 'c': 6}, combine_dicts(dicts))
+        self.assertEqual({'a': 5, 'c': 6}, combine_dicts_iter(iter(dicts)))
+        self.assertEqual({'a': 5, 'b': 2, 'c': 6},
+                combine_dicts_iter(iter(dicts), default=0))
+        self.assertEqual({'a': 0, 'b': 0, 'c': 1},
+                combine_dicts_iter(dicts, 'min', default=0))
+        self.assertEqual({'a': 4, 'c': 3}, combine_dicts_iter(dicts, 'max'))
+        self.assertEqual({'a': 3, 'b': 3, 'c': 3},
+                combine_dicts_iter(dicts, 'count', default=0))
+        self.assertEqual({'a': 5 / 3.0, 'b': 4 / 3.0, 'c': 2.0},
+                combine_dicts_iter(dicts, 'mean', default=1))
+        self.assertEqual({'a': 0, 'c': 6},
+                combine_dicts_iter(dicts, lambda a, b: a * b))
+        self.assertEqual({}, combine_dicts_iter([]))
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_combine_dicts_iter_numpy(self):
+        dicts = [{'a': 1, 'b': 2, 'c': 3}, {'a': 4, 'c': 1}, {'c': 2, 'a': 0}]
+        for reducer in ('sum', 'min', 'max', 'count', 'mean'):
+            for default in (None, 0, 1):
+                self.assertEqual(
+                        combine_dicts_iter(dicts, reducer, default),
+                        combine_dicts_iter(dicts, reducer, default,
+                            use_numpy=True))
+
+        # An empty shard must not turn integer results into floats
+        combined = combine_dicts_iter([{'a': 1}, {}], 'sum', default=0,
+                use_numpy=True)
+        self.assertEqual({'a': 1}, combined)
+        self.assertEqual(int, type(combined['a']))
+        self.assertEqual({}, combine_dicts_iter([{}, {}], 'sum', default=0,
+                use_numpy=True))
+
+    def test_order(self):
+        dict_ = {'b': 2, 'a': 3, 'd': 1, 'c': 3}
+        self.assertEqual(['a', 'b', 'c', 'd'], list(order(dict_)))
+        self.assertEqual(['d', 'b', 'a', 'c'], list(order(dict_, by_value=True)))
+        self.assertEqual(['a', 'c'], list(order(dict_, by_value=True,
+            reverse=True, limit=2)))
+        self.assertEqual(['a', 'b'], list(order(dict_, limit=2)))
+        top = order(dict_, by_value=True, reverse=True, limit=3, dict_type=dict)
+        self.assertEqual(dict, type(top))
+        self.assertEqual([('a', 3), ('c', 3), ('b', 2)], list(top.items()))
+
+    def test_group_by_key(self):
+        col = [
+                {'k': 'a', 'n': 1, 'm': {'x': 'p'}},
+                {'k': 'b', 'n': 2, 'm': {'x': 'q'}},
+                {'k': 'a', 'n': 3, 'm': {'x': 'p'}},
+                {'n': 4},
+                ]
+        groups = group_by_key(col, 'k')
+        self.assertEqual(['a', 'b'], list(groups))
+        self.assertTrue(groups['a'][0] is col[0])
+        self.assertTrue(groups['a'][1] is col[2])
+        self.assertEqual({'a': [1, 3], 'b': [2]}, group_by_key(col, 'k', 'n'))
+        self.assertEqual({'p': ['a', 'a'], 'q': ['b']},
+                group_by_key(col, 'm.x', 'k'))
+        self.assertEqual({'a': [{'n': 1, 'm': {'x': 'p'}}, {'n': 3, 'm': {'x': 'p'}}],
+            'b': [{'n': 2, 'm': {'x': 'q'}}]},
+            group_by_key(col, 'k', include_key=False))
+        self.assertEqual({'n': 3, 'm': {'x': 'p'}}, to_dict_by_key(col, 'k')['a'])
+
+    def test_flatten(self):
+        def tree():
+            return {'id': 1, 'children': [
+                {'id': 2, 'children': [{'id': 3}, {'id': 4}]},
+                {'id': 5},
+                ]}
+        self.assertEqual([{'id': 3}, {'id': 4}, {'id': 2}, {'id': 5}, {'id': 1}],
+                flatten(tree()))
+
+        source = tree()
+        self.assertEqual([1, 2, 3, 4, 5], [node['id'] for node in
+            iter_flatten(source, post_order=False, destructive=False)])
+        self.assertEqual(tree(), source)
+        self.assertEqual([(3, 2, 2), (4, 2, 2), (2, 1, 1), (5, 1, 1), (1, 0, None)],
+                [(node['id'], depth, parent and parent['id']) for
+                    node, depth, parent in iter_flatten(source, with_info=True)])
+        self.assertEqual({'id': 1}, source)
+
     def test_get_value_for_key(self):
         dict_ = {
                 'foo': [
@@ -89,5 +304,31 @@ class TestDictutils(unittest.TestCase):
                 }
         self.assertEquals(3, get_value_for_key(dict_, 'gar'))
 
+    def test_key_index(self):
+        dict_ = {
+                'foo': [
+                    {'bar': 0, 'gar': 3},
+                    {'bar': 2, 'baz': {'gar': 4}},
+                    ],
+                'gar': '',
+                }
+        index = KeyIndex(dict_)
+        self.assertEqual(0, index.first('bar'))
+        self.assertEqual(3, index.first('gar'))
+        self.assertEqual([3, 4, ''], index.all('gar'))
+        self.assertEqual([('foo', 0, 'gar'), ('foo', 1, 'baz', 'gar'), ('gar',)],
+                index.paths('gar'))
+        self.assertEqual(None, index.first('missing'))
+
+        index.update(('foo', 1, 'baz'), {'bla': 5})
+        self.assertEqual({'bla': 5}, dict_['foo'][1]['baz'])
+        self.assertEqual([3, ''], index.all('gar'))
+        self.assertEqual(5, index.first('bla'))
+        self.assertEqual({'bla': 5}, index.first('baz'))
+
+        index.update(('foo',), [])
+        self.assertEqual([''], index.all('gar'))
+        self.assertFalse('bar' in index)
+
 if __name__ == "__main__":
     unittest.main()
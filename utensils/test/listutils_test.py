@@ -1,16 +1,151 @@
+import asyncio
+import io
+import os
+import random
+import subprocess
+import sys
+from itertools import count
+from itertools import islice
 import unittest
 
+from utensils.listutils import abatch
+from utensils.listutils import adv_enumerate
+from utensils.listutils import async_roundrobin
 from utensils.listutils import batch
 from utensils.listutils import merge
+from utensils.listutils import merge_iter
+from utensils.listutils import MultiListView
+from utensils.listutils import OrderedSet
+from utensils.listutils import partition_stream
+from utensils.listutils import promote
+from utensils.listutils import parallel_map
+from utensils.listutils import Progress
 from utensils.listutils import find
+from utensils.listutils import flatten
+from utensils.listutils import get_iterable_len
+from utensils.listutils import iflatten
+from utensils.listutils import ListIndex
 from utensils.listutils import push_to_front
+from utensils.listutils import register_length_estimator
+from utensils.listutils import roundrobin
+from utensils.listutils import BloomFilter
 from utensils.listutils import dedup
+from utensils.listutils import dedup_iter
+from utensils.listutils import DEDUP_BLOOM
+from utensils.listutils import DEDUP_WINDOW
+from utensils.listutils import shuffle
 from utensils.listutils import shuffle_multi
+from utensils.listutils import split
 from utensils.listutils import to_multilist
+from utensils.listutils import weighted_merge_iter
+from utensils.listutils import weighted_roundrobin
 
 class TestListutils(unittest.TestCase):
     def test_batch(self):
         print([b for b in batch([1], 10)])
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]], list(batch(range(7), 3)))
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]],
+                list(batch(iter(range(7)), 3)))
+        words = ['aa', 'bbb', 'c', 'dddd', 'e']
+        self.assertEqual([['aa'], ['bbb', 'c'], ['dddd'], ['e']],
+                list(batch(words, max_bytes=4)))
+        self.assertEqual([['aa', 'bbb'], ['c', 'dddd'], ['e']],
+                list(batch(words, 2, max_bytes=100)))
+        self.assertEqual([[1, 2], [3]],
+                list(batch([1, 2, 3], max_bytes=3, size_fn=lambda i: i)))
+
+    def test_abatch(self):
+        async def slow_source():
+            for i in range(3):
+                yield i
+            await asyncio.sleep(0.2)
+            for i in range(3, 5):
+                yield i
+
+        async def collect(**kwargs):
+            return [b async for b in abatch(slow_source(), **kwargs)]
+
+        self.assertEqual([[0, 1], [2, 3], [4]], asyncio.run(collect(size=2)))
+        self.assertEqual([[0, 1, 2], [3, 4]],
+                asyncio.run(collect(size=10, max_wait=0.05)))
+        self.assertEqual([[0, 1], [2, 3], [4]], asyncio.run(
+                collect(max_bytes=2, size_fn=lambda item: 1)))
+
+        async def task_counts(**kwargs):
+            async def source():
+                for i in range(5):
+                    counts.append(len(asyncio.all_tasks()))
+                    yield i
+            counts = []
+            batches = [b async for b in abatch(source(), **kwargs)]
+            return batches, counts
+
+        # Without max_wait, items are not awaited through extra tasks
+        for kwargs in ({'size': 2}, {'max_bytes': 2, 'size_fn': lambda i: 1}):
+            batches, counts = asyncio.run(task_counts(**kwargs))
+            self.assertEqual([[0, 1], [2, 3], [4]], batches)
+            self.assertEqual([1] * 5, counts)
+
+    def test_parallel_map(self):
+        items = list(range(-50, 50))
+        self.assertEqual([i * 2 for i in items],
+                list(parallel_map(lambda i: i * 2, iter(items), 7, 3)))
+        self.assertEqual(sorted(map(abs, items)), sorted(parallel_map(abs,
+            items, 10, 2, ordered=False)))
+        self.assertEqual(list(map(abs, items)), list(parallel_map(abs, items,
+            25, 2, executor='process')))
+
+        def fail(i):
+            if i == 20:
+                raise ValueError(i)
+            return i
+        self.assertRaises(ValueError, list, parallel_map(fail, items, 5, 2))
+
+    def test_adv_enumerate(self):
+        self.assertEqual(list(range(10)), list(adv_enumerate(range(20), end=10)))
+        self.assertEqual([(5, 'a'), (6, 'b')],
+                list(adv_enumerate(iter('ab'), start=5, get_tuple=True)))
+
+        progress = Progress(total=5, interval=60)
+        items = list(adv_enumerate((i for i in range(5)), progress=progress))
+        self.assertEqual(list(range(5)), items)
+        stats = progress.as_dict()
+        self.assertEqual(5, stats['count'])
+        self.assertEqual(5, stats['total'])
+        self.assertEqual(0, stats['eta'])
+        self.assertTrue(stats['rate'] > 0)
+        self.assertTrue(str(progress).startswith('completed 5/5'))
+
+    def test_get_iterable_len(self):
+        class Cursor(object):
+            counts = 0
+            def __iter__(self):
+                return iter(range(7))
+            def count(self):
+                Cursor.counts += 1
+                return 7
+
+        class EstimatedCursor(Cursor):
+            pass
+
+        self.assertEqual(3, get_iterable_len([1, 2, 3]))
+        self.assertEqual(None, get_iterable_len(i for i in range(3)))
+        self.assertEqual(0, get_iterable_len(iter([]), default=0))
+        self.assertEqual(None, get_iterable_len(iter([1, 2])))
+        self.assertEqual(2, get_iterable_len(iter([1, 2]), estimate=True))
+        self.assertEqual(None, get_iterable_len(count()))
+
+        cursor = Cursor()
+        self.assertEqual(7, get_iterable_len(cursor))
+        self.assertEqual(7, get_iterable_len(cursor))
+        self.assertEqual(1, Cursor.counts)
+
+        register_length_estimator(EstimatedCursor, lambda c: 5)
+        cursor = EstimatedCursor()
+        self.assertEqual(5, get_iterable_len(cursor, estimate=True))
+        self.assertEqual(1, Cursor.counts)
+        self.assertEqual(7, get_iterable_len(cursor))
+        self.assertEqual(2, Cursor.counts)
 
     def test_find(self):
         self.assertEquals(None, find(range(5), lambda i: i>4))
@@ -23,6 +158,56 @@ class TestListutils(unittest.TestCase):
         self.assertEquals([4, 0, 1, 2, 3], push_to_front(result, lambda i: i>3))
         self.assertEquals([3, 0, 1, 2, 4], push_to_front(result, lambda i: i>2))
 
+    def test_list_index(self):
+        words = ['bb', 'a', 'ccc', 'dd', 'e']
+        index = ListIndex(words, {'len': len, 'first': lambda w: w[0]})
+        self.assertEqual(0, index.find('len', 2))
+        self.assertEqual([0, 3], index.find_all('len', 2))
+        self.assertEqual(None, index.find('len', 4))
+        self.assertEqual([], index.find_all('len', 4))
+        self.assertEqual('ccc', index.get('first', 'c'))
+        self.assertEqual('z', index.get('first', 'z', 'z'))
+        self.assertRaises(KeyError, index.find, 'last', 'a')
+
+        self.assertEqual(['dd', 'bb', 'a', 'ccc', 'e'], index.push_to_front('first', 'd'))
+        self.assertTrue(words is index.push_to_front('len', 2))
+        self.assertTrue(words is index.push_to_front('len', 4))
+        self.assertEqual(['a', 'e', 'bb', 'ccc', 'dd'],
+                         list(index.promote('len', 1, limit=None)))
+        self.assertEqual(words, ['bb', 'a', 'ccc', 'dd', 'e'])
+
+    def test_promote(self):
+        self.assertEqual([3, 0, 1, 2, 4], list(promote(range(5), lambda i: i > 2)))
+        self.assertEqual([1, 3, 0, 2, 4],
+                         list(promote(iter(range(5)), lambda i: i % 2, limit=None)))
+        self.assertEqual(list(range(5)), list(promote(range(5), lambda i: i > 9)))
+        index = ListIndex(list('abcab'), {'char': lambda c: c})
+        self.assertEqual(list('bbaca'), list(promote(index, ('char', 'b'), limit=2)))
+
+        promoted = promote(count(), lambda i: i == 3)
+        self.assertEqual([3, 0, 1, 2, 4], list(islice(promoted, 5)))
+
+    def test_flatten(self):
+        nested = [1, [2, (3, [4])], 'ab', {'a': 1}, range(5, 6), [[6]]]
+        self.assertEqual([1, 2, 3, 4, 'ab', {'a': 1}, 5, 6], flatten(nested))
+        self.assertEqual([1, 2, (3, [4]), 'ab', {'a': 1}, 5, [6]],
+                         flatten(nested, max_depth=1))
+        self.assertEqual([1, [2]], flatten([1, [2]], max_depth=0))
+        self.assertEqual([(1, 2), 3], flatten([[(1, 2)], 3], atomic_types=(tuple,)))
+        # Strings stay leaves even when left out of atomic_types
+        self.assertEqual(['ab', 'c', b'd', 1], flatten([['ab', 'c'], [b'd', 1]],
+                                                  atomic_types=(dict,)))
+        self.assertEqual([1, 2], flatten([{1: 'a'}, (2,)], atomic_types=()))
+
+        deep = [0]
+        for i in range(1, 10000):
+            deep = [deep, i]
+        self.assertEqual(list(range(10000)), flatten(deep))
+
+        leaves = iflatten([range(3), [[3]]])
+        self.assertEqual(0, next(leaves))
+        self.assertEqual([1, 2, 3], list(leaves))
+
     def test_merge(self):
         merged = merge(list(range(0, 10)), list(range(100, 110)), mix_percentage=0)
         merged = [m for m in merged[:10] if m <= 100]
@@ -31,6 +216,47 @@ class TestListutils(unittest.TestCase):
         merged = [m for m in merged[:10] if m >= 100]
         self.assertEquals(10, len(merged))
 
+    def test_merge_iter(self):
+        merged = list(merge_iter(iter(range(0, 10)), iter(range(100, 110))))
+        self.assertEqual(list(range(0, 10)) + list(range(100, 110)), merged)
+        merged = list(merge_iter(range(0, 10), range(100, 110), 100))
+        self.assertEqual(list(range(100, 110)) + list(range(0, 10)), merged)
+        merged = list(merge_iter(range(0, 10), range(100, 110), 50, seed=1))
+        self.assertEqual(merged, list(merge_iter(range(0, 10),
+            range(100, 110), 50, seed=1)))
+        self.assertEqual(list(range(0, 10)), [m for m in merged if m < 100])
+
+        merged = list(weighted_merge_iter(['ab', 'cd', 'ef'], [1, 2, 0], seed=1))
+        self.assertEqual(['e', 'f'], merged[-2:])
+        self.assertEqual(['a', 'b', 'c', 'd'], sorted(merged[:4]))
+
+    def test_roundrobin(self):
+        self.assertEqual(list('ADEBFC'), list(roundrobin('ABC', 'D', 'EF')))
+        self.assertEqual([], list(roundrobin()))
+        shards = [range(i, 3000, 1000) for i in range(1000)]
+        self.assertEqual(list(range(3000)), list(roundrobin(*shards)))
+
+        self.assertEqual(list('ABDCEF'),
+                         list(weighted_roundrobin(['ABC', 'DEF'], [2, 1])))
+        self.assertEqual(list('ABCDEF'),
+                         list(weighted_roundrobin(['ABC', '', 'DEF'], [3, 1, 2])))
+        self.assertRaises(ValueError, list, weighted_roundrobin(['A'], [1, 2]))
+        self.assertRaises(ValueError, list, weighted_roundrobin(['A'], [0]))
+
+    def test_async_roundrobin(self):
+        async def source(items, delay):
+            for item in items:
+                await asyncio.sleep(delay)
+                yield item
+
+        async def collect(*aiterables):
+            return [i async for i in async_roundrobin(*aiterables)]
+
+        self.assertEqual(['a', 'b', 'c', 'x'], asyncio.run(collect(
+            source('abc', 0.01), source('x', 0.1))))
+        self.assertEqual(['a', 'x', 'b', 'y'], asyncio.run(collect(
+            source('ab', 0), source('xy', 0))))
+
     def test_dedup(self):
         self.assertEquals(2, len(dedup([
             {'foo': 'bar'},
@@ -38,6 +264,50 @@ class TestListutils(unittest.TestCase):
             {'foo': 'bar'},
             ], fn=lambda k: tuple(k.items()))))
 
+    def test_dedup_iter(self):
+        items = [1, 2, 1, 3, 1, 4, 5, 1]
+        stats = {}
+        self.assertEqual([1, 2, 3, 4, 5], list(dedup_iter(items, stats=stats)))
+        self.assertEqual({'seen': 8, 'dropped': 3}, stats)
+
+        # Only the last two keys are remembered.
+        stats = {}
+        self.assertEqual([1, 2, 3, 4, 5, 1], list(dedup_iter(items,
+            mode=DEDUP_WINDOW, window=2, stats=stats)))
+        self.assertEqual({'seen': 8, 'dropped': 2}, stats)
+
+        stats = {}
+        deduped = list(dedup_iter((i % 1000 for i in range(3000)),
+            mode=DEDUP_BLOOM, capacity=1000, error_rate=0.01, stats=stats))
+        self.assertTrue(len(deduped) > 950)
+        self.assertEqual(len(deduped), len(set(deduped)))
+        self.assertEqual(3000 - len(deduped), stats['dropped'])
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(100, 0.01)
+        self.assertFalse(bloom.add('foo'))
+        self.assertTrue(bloom.add('foo'))
+        self.assertTrue('foo' in bloom)
+        self.assertTrue(all(i in bloom for i in range(100) if not bloom.add(i)))
+
+        # hash(-1) == hash(-2), which must not make them collide
+        self.assertEqual([-1, -2], list(dedup_iter([-1, -2], mode=DEDUP_BLOOM,
+                                                   capacity=1000)))
+        self.assertEqual([1, 'a', (1, 'a')], list(dedup_iter(
+            [1, 1.0, True, 'a', (1, 'a'), (1.0, 'a')], mode=DEDUP_BLOOM,
+            capacity=1000)))
+
+        # String keys set the same bits whatever the hash seed
+        script = ('from utensils.listutils import BloomFilter; '
+                  'b = BloomFilter(1000); b.add("foo"); b.add(("bar", 2)); '
+                  'print(bytes(b.bits).hex())')
+        outputs = set()
+        for seed in ('1', '2'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.check_output([sys.executable, '-c', script],
+                                                env=env))
+        self.assertEqual(1, len(outputs))
+
     def test_shuffle_multi(self):
         v, k = shuffle_multi(range(10), range(10))
         self.assertEquals(v, k)
@@ -51,10 +321,125 @@ class TestListutils(unittest.TestCase):
 
         self.assertEquals(([], []), shuffle_multi([], []))
 
+    def test_shuffle(self):
+        state = random.getstate()
+        shuffled = shuffle(range(100), seed=3)
+        self.assertEqual(state, random.getstate())
+        self.assertEqual(shuffled, shuffle(range(100), seed=3))
+        self.assertEqual(list(range(100)), sorted(shuffled))
+        self.assertNotEqual(list(range(100)), shuffled)
+
+        v, k = shuffle_multi(list(range(10)), list('abcdefghij'), seed=3)
+        self.assertEqual([v, k], shuffle_multi(range(10), 'abcdefghij', seed=3))
+        self.assertEqual(k, ['abcdefghij'[i] for i in v])
+
+    def test_split(self):
+        self.assertEqual([[1, 3], [2, 4]], split([1, 2, 3, 4], lambda x: x % 2))
+        self.assertEqual([(1, [1, 3]), (0, [2, 4])],
+                         split([1, 2, 3, 4], lambda x: x % 2, with_keys=True))
+
+    def test_partition_stream(self):
+        sinks = partition_stream(range(10), lambda x: x % 3)
+        self.assertEqual({0: [0, 3, 6, 9], 1: [1, 4, 7], 2: [2, 5, 8]}, sinks)
+        self.assertEqual([0, 1, 2], list(sinks))
+
+        flushes = []
+        partition_stream(range(7), lambda x: x % 2,
+                         lambda key: lambda items: flushes.append((key, items)),
+                         max_buffer=2)
+        self.assertEqual([(0, [0, 2]), (1, [1, 3]), (0, [4, 6]), (1, [5])],
+                         flushes)
+
+        files = partition_stream(['a1', 'b1', 'a2'], lambda line: line[0],
+                                 lambda key: io.StringIO(), max_buffer=1)
+        self.assertEqual('a1a2', files['a'].getvalue())
+        self.assertRaises(TypeError, partition_stream, [1], str, lambda key: 1)
+
     def test_to_multilist(self):
         self.assertEquals(5, len(to_multilist(range(25), 5)))
         self.assertEquals(3, len(to_multilist(range(25), 5, 3)))
         self.assertEquals(14, to_multilist(range(25), 5, 3)[-1][-1])
 
+    def test_ordered_set(self):
+        for indexed in (False, True):
+            s = OrderedSet('abracadabra', indexed=indexed)
+            self.assertEqual(list('abrcd'), list(s))
+            self.assertEqual(list('dcrba'), list(reversed(s)))
+            self.assertEqual('c', s[3])
+            self.assertEqual(['b', 'r'], list(s[1:3]))
+            self.assertEqual(2, s.index('r'))
+            self.assertRaises(ValueError, s.index, 'z')
+            s.discard('b')
+            s.discard('z')
+            self.assertEqual('c', s[2])
+            self.assertEqual('d', s.pop())
+            self.assertEqual('a', s.pop(last=False))
+            self.assertEqual(OrderedSet('rc'), s)
+
+            s = OrderedSet(range(10), indexed=indexed)
+            for i in range(8):
+                s.discard(i)
+            self.assertEqual([8, 9], list(s))
+            self.assertEqual(8, s[0])
+            self.assertEqual(1, s.index(9))
+            self.assertEqual(2, len(s))
+
+    def test_ordered_set_indexed_discards(self):
+        s = OrderedSet(range(100), indexed=True)
+        expected = list(range(100))
+        for i in range(0, 40, 2):
+            s.discard(i)
+            # Only the odd keys below i are left in front of i + 1
+            self.assertEqual(i + 1, s[i // 2])
+            self.assertEqual(i + 2, s[i // 2 + 1])
+            self.assertEqual(99, s[-1])
+            self.assertEqual(i // 2 + 1, s.index(i + 2))
+        s.add(-1)
+        self.assertEqual(-1, s[-1])
+        self.assertEqual(len(s) - 1, s.index(-1))
+        del expected[0:40:2]
+        expected.append(-1)
+        self.assertEqual(expected[10:20], s[10:20])
+        self.assertEqual(expected, list(s))
+        self.assertRaises(IndexError, lambda: s[len(s)])
+
+    def test_ordered_set_algebra(self):
+        a = OrderedSet('abcde')
+        self.assertEqual(list('abcdeyx'), list(a | 'yxa'))
+        self.assertEqual(list('bd'), list(a & 'dzb'))
+        self.assertEqual(list('ace'), list(a - 'db'))
+        self.assertEqual(list('abezx'), list(a ^ 'dczx'))
+        a |= 'f'
+        a -= 'a'
+        self.assertEqual(list('bcdef'), list(a))
+        self.assertEqual(list('bc'), list(a.intersection('cbz', 'abc')))
+        self.assertNotEqual(OrderedSet('fedcb'), a)
+        self.assertEqual(set('fedcb'), a)
+        self.assertEqual(a, a.copy())
+
+    def test_multilist_view(self):
+        for cols, rows in ((5, None), (5, 3), (7, None), (7, 2), (30, None)):
+            expected = to_multilist(list(range(25)), cols, rows)
+            for source in (list(range(25)), iter(range(25))):
+                view = MultiListView(source, cols, rows)
+                self.assertEqual(expected, list(view))
+            view = MultiListView(iter(range(25)), cols, rows)
+            self.assertEqual(expected[1:], view[1:])
+            self.assertEqual(expected[-1], view[-1])
+            self.assertEqual(len(expected), len(view))
+            self.assertEqual(expected[::-1], view[::-1])
+
+        consumed = []
+        def source():
+            for i in count():
+                consumed.append(i)
+                yield i
+        view = MultiListView(source(), 10)
+        self.assertEqual([list(range(10)), list(range(10, 20))], view[:2])
+        self.assertEqual([10, 11, 12], view[1][:3])
+        self.assertEqual(20, len(consumed))
+        self.assertRaises(IndexError, lambda: MultiListView([1], 3)[1])
+        self.assertRaises(ValueError, MultiListView, [1], 0)
+
 if __name__ == "__main__":
     unittest.main()
@@ -3,6 +3,15 @@ import unittest
 
 from utensils.stringutils import to_latin, to_upper_first_chars
 from utensils.stringutils import parse_price
+from utensils.stringutils import string_contains
+from utensils.stringutils import _get_keyword_matcher
+from utensils.stringutils import MATCHER_CACHE_MAX_KEYWORDS
+from utensils.stringutils import normalize
+from utensils.stringutils import slugify
+from utensils.stringutils import KeywordMatcher
+from utensils.stringutils import MATCH_AUTOMATON
+from utensils.stringutils import MATCH_REGEX
+from utensils.stringutils import MATCH_SCAN
 
 class TestStringutils(unittest.TestCase):
     def test_to_upper_first_chars(self):
@@ -20,5 +29,53 @@ class TestStringutils(unittest.TestCase):
         self.assertEquals(308.0, parse_price('$308.00 - $440.00', min))
         self.assertEquals(440.0, parse_price('$308.00 - $440.00'))
 
+    def test_string_contains(self):
+        self.assertTrue(string_contains('Big Apple', ['APPLE']))
+        self.assertFalse(string_contains('Big Apple', ['APPLE'], lower=False))
+        self.assertTrue(string_contains('Big Apple', ['App'], lower=False))
+        self.assertTrue(string_contains('Big Apple', ['APPLE'], full_word=True))
+        self.assertFalse(string_contains('Big Apples', ['apple'], full_word=True))
+        self.assertFalse(string_contains('', ['']))
+        self.assertTrue(string_contains('a', ['']))
+
+        # Large keyword lists are scanned, not compiled and cached.
+        keywords = ['k%s' % i for i in range(MATCHER_CACHE_MAX_KEYWORDS + 1)]
+        _get_keyword_matcher.cache_clear()
+        self.assertTrue(string_contains('a K1000 b', keywords))
+        self.assertFalse(string_contains('a k b', keywords))
+        self.assertTrue(string_contains('a K1000 b', keywords[-2:]))
+        self.assertEqual(1, _get_keyword_matcher.cache_info().currsize)
+
+    def test_keyword_matcher(self):
+        keywords = ['he', 'She', 'his', 'hers'] + ['pad%s' % i for i in range(20)]
+        for engine in (MATCH_SCAN, MATCH_AUTOMATON, MATCH_REGEX):
+            matcher = KeywordMatcher(keywords, engine=engine)
+            self.assertTrue(matcher.contains('uSHErs'))
+            self.assertFalse(matcher.contains('hi s'))
+            self.assertEqual(['she', 'hers', 'he'], matcher.find_all('uSHErs'))
+            self.assertEqual([True, False, True],
+                             matcher.contains_many(['his', 'hi', 'pad19']))
+            self.assertEqual([['his'], []], matcher.find_all_many(['his', '']))
+        self.assertEqual(MATCH_SCAN, KeywordMatcher(keywords[:16]).engine)
+        self.assertEqual(MATCH_REGEX, KeywordMatcher(keywords).engine)
+        self.assertEqual(MATCH_AUTOMATON, KeywordMatcher(
+            ['k%s' % i for i in range(5001)]).engine)
+        self.assertRaises(ValueError, KeywordMatcher, keywords, engine='grep')
+
+        matcher = KeywordMatcher(['New', 'york', 'new'], full_word=True)
+        self.assertEqual(('new', 'york'), matcher.keywords)
+        self.assertEqual(['york', 'new'], matcher.find_all('York new NEW yorker'))
+        self.assertFalse(matcher.contains('newyork'))
+
+    def test_normalize(self):
+        self.assertEqual('a & b', normalize(' A &amp; B&nbsp;'))
+        self.assertEqual('x', normalize('&amp;nbsp;X'))
+        self.assertEqual(None, normalize(None))
+
+    def test_slugify(self):
+        self.assertEqual('hello-world-2', slugify('Hello,  World! 2'))
+        self.assertEqual('gzel-ev', slugify(u'Güzel ev'))
+        self.assertEqual('-a-b', slugify(' a\tb'.replace('\t', ' ')))
+
 if __name__ == "__main__":
     unittest.main()